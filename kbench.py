@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for kparse on synthetic systems
+"""
+
+# Run from the command line to print a JSON report:
+    # python kbench.py [--sizes 100,1000,10000] [--repeat 20] [--shapes chain,fanout] [--out report.json]
+# Each result records which function was timed, on what shape of system, at what size, and:
+    # calls, seconds: how many timed calls were made and how long they took in total
+    # throughput: calls per second
+    # latency: seconds per call at the 50th, 90th and 99th percentiles, and the worst call
+    # peakMemory: the most memory (bytes, as seen by tracemalloc) allocated during one untimed call
+
+import sys
+import json
+import time
+import platform
+import tracemalloc
+
+import kparse
+
+
+########################## Synthetic systems ##########################
+##### Each generator returns (system, node): a system of about n nodes, and the node whose evaluation touches all of them
+
+# n0 = 1, and each node adds one to the one before: evaluating the last follows the whole chain
+def chainSystem(n):
+    system = {'n0' : 1}
+    for i in range(1, n): system['n' + str(i)] = '(+ parent.n' + str(i-1) + ' 1)'
+    return system, 'n' + str(n-1)
+
+# n nodes that each read one root, and a total that reads all of them
+def fanOutSystem(n):
+    system = {'root' : 2}
+    for i in range(n): system['f' + str(i)] = '(* parent.root ' + str(i) + ')'
+    system['total'] = '(sum [' + ','.join('parent.f' + str(i) for i in range(n)) + '])'
+    return system, 'total'
+
+# Layers of 10 nodes in which each node reads two nodes of the layer before, so every node is reached many ways
+def diamondSystem(n, width=10):
+    layers = max(1, n // width)
+    system = {}
+    for j in range(width): system['d0_' + str(j)] = j
+    for i in range(1, layers):
+        for j in range(width):
+            system['d' + str(i) + '_' + str(j)] = ('(+ parent.d' + str(i-1) + '_' + str(j) +
+                                                   ' parent.d' + str(i-1) + '_' + str((j+1) % width) + ')')
+    return system, 'd' + str(layers-1) + '_0'
+
+# n levels of nested dicts, each x reading the x of the level around it through parent.parent
+def nestedSystem(n):
+    system = {'x' : 1}
+    level = system
+    node = 'x'
+    for i in range(1, n):
+        level['c'] = {'x' : '(+ parent.parent.x 1)'}
+        level = level['c']
+        node = 'c.' + node
+    return system, node
+
+# One list of n numbers and nodes reducing it
+def listSystem(n):
+    system = {'big' : list(range(n)), 'other' : list(range(0, 2*n, 2)),
+              'total' : '(sum parent.big)', 'size' : '(cardinality parent.big)', 'both' : '(dot parent.big parent.other)'}
+    return system, 'both'
+
+generators = {'chain' : chainSystem, 'fanout' : fanOutSystem, 'diamond' : diamondSystem,
+              'nested' : nestedSystem, 'list' : listSystem}
+
+# A path to the same node as node that climbs to the top of the system through 'this' and 'parent' and back down,
+# so looking it up resolves one 'parent' for each level node is nested at
+def climbingPath(node):
+    return node + '.this' + '.parent' * (node.count('.') + 1) + '.' + node
+
+
+########################## Measuring ##########################
+
+# Calls fn until repeat calls have been timed (after one untimed warm-up call) and summarizes the timings
+# fn takes no arguments; name, shape and size are just copied into the result
+def measure(name, shape, size, fn, repeat):
+
+    # Warm up (e.g. the compile cache), then look at the memory of one call on its own
+    fn()
+    tracemalloc.start()
+    fn()
+    peakMemory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+
+    seconds = sum(latencies)
+    latencies.sort()
+    return {'benchmark' : name, 'shape' : shape, 'size' : size, 'calls' : repeat, 'seconds' : seconds,
+            'throughput' : repeat / seconds if seconds > 0 else None,
+            'latency' : {'p50' : percentile(latencies, 50), 'p90' : percentile(latencies, 90),
+                         'p99' : percentile(latencies, 99), 'max' : latencies[len(latencies)-1]},
+            'peakMemory' : peakMemory}
+
+# The pth percentile of a sorted list, interpolating between neighbours
+def percentile(ordered, p):
+    position = (len(ordered) - 1) * p / 100.0
+    below = int(position)
+    above = min(below + 1, len(ordered) - 1)
+    return ordered[below] + (ordered[above] - ordered[below]) * (position - below)
+
+
+########################## Benchmarks ##########################
+
+# Benchmarks for one shape of system at one size; returns a list of results
+def benchmarkShape(shape, size, repeat):
+
+    system, node = generators[shape](size)
+
+    results = []
+    results.append(measure('parse', shape, size, lambda: kparse.parse(system, node), repeat))
+    results.append(measure('followPath', shape, size, lambda: kparse.followPath(system, node), repeat))
+
+    # Reuse one index, as evaluation does within a pass
+    index = kparse.PathIndex(system)
+    results.append(measure('followPath (indexed)', shape, size, lambda: kparse.followPath(system, node, index), repeat))
+
+    # The same lookups through 'this' and 'parent', as formulas make them
+    relative = climbingPath(node)
+    results.append(measure('followPath (relative)', shape, size, lambda: kparse.followPath(system, relative), repeat))
+    results.append(measure('followPath (relative, indexed)', shape, size,
+                           lambda: kparse.followPath(system, relative, index), repeat))
+
+    value = kparse.followPath(system, node)['value']
+    results.append(measure('setValue', shape, size, lambda: kparse.setValue(system, node, value), repeat))
+    results.append(measure('setValue (relative)', shape, size, lambda: kparse.setValue(system, relative, value), repeat))
+    return results
+
+# Benchmarks for the operators on their own, with arguments of about size elements
+def benchmarkOperators(size, repeat):
+
+    A = list(range(size))
+    B = list(range(0, 2*size, 2))
+    numbers = [float(i) for i in range(size)]
+    evaluable = [True] * size
+
+    results = []
+    results.append(measure('operate +', 'list', size,
+                           lambda: kparse.operateEntry(kparse.operatorRegistry['+'], evaluable, numbers), repeat))
+    results.append(measure('operate sum', 'list', size,
+                           lambda: kparse.operateEntry(kparse.operatorRegistry['sum'], [True], [A]), repeat))
+    results.append(measure('union', 'list', size, lambda: kparse.union(A, B), repeat))
+    results.append(measure('intersection', 'list', size, lambda: kparse.intersection(A, B), repeat))
+    results.append(measure('dot', 'list', size, lambda: kparse.dot(A, B), repeat))
+    return results
+
+# Runs every benchmark at every size and returns the report as a dict
+# shapes defaults to every generator
+def runBenchmarks(sizes=[100, 1000, 10000], repeat=20, shapes=None):
+
+    if shapes == None: shapes = list(generators)
+    results = []
+    for size in sizes:
+        for shape in shapes: results.extend(benchmarkShape(shape, size, repeat))
+        results.extend(benchmarkOperators(size, repeat))
+
+    return {'python' : platform.python_version(), 'implementation' : platform.python_implementation(),
+            'machine' : platform.machine(), 'numpy' : not kparse.numpy == None, 'repeat' : repeat, 'results' : results}
+
+
+if __name__ == '__main__':
+
+    sizes = [100, 1000, 10000]
+    repeat = 20
+    out = None
+    shapes = None
+
+    args = sys.argv[1:]
+    for i in range(0, len(args) - 1, 2):
+        if args[i] == '--sizes': sizes = [int(size) for size in args[i+1].split(',')]
+        elif args[i] == '--repeat': repeat = int(args[i+1])
+        elif args[i] == '--shapes': shapes = args[i+1].split(',')
+        elif args[i] == '--out': out = args[i+1]
+        else: sys.exit('Unknown option ' + args[i])
+
+    report = json.dumps(runBenchmarks(sizes, repeat, shapes), indent=2)
+    if out == None: print(report)
+    else:
+        with open(out, 'w') as f: f.write(report + '\n')
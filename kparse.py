@@ -21,13 +21,54 @@ Created on Sun Oct 13 15:28:54 2019
     # If you have a prefix expression inside a list, sub-expressions can't contain commas
     # If you have a list, can't add a space before first elem: [5,3] is ok but [ 5,3] is not
 
+import os
+import json
+import asyncio
+import time
+import array
+import pickle
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections.abc import Mapping
+
+# NumPy is optional; it's only needed to evaluate with EvalContext(vectorize=True)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Maximum number of compiled formulas kept in the compile cache
+compileCacheSize = 4096
+
+# Compiled formulas keyed by formula text, least recently used first
+# Evaluation may run on several threads at once (see evaluateParallel and ObservableSystem), so hold compileLock
+# while reading or changing it
+compileCache = OrderedDict()
+compileLock = threading.Lock()
+
+# Problems found while evaluating go here when an EvalContext's diagnostics are 'log'
+logger = logging.getLogger('kparse')
+
+# Diagnostic codes, and the logging level each is logged at
+diagnosticLevels = {'invalid-path' : logging.ERROR, 'loop' : logging.ERROR, 'not-evaluable' : logging.WARNING,
+                    'set-failed' : logging.ERROR, 'arity' : logging.ERROR, 'not-enough-values' : logging.ERROR,
+                    'invalid-input' : logging.ERROR, 'input-failed' : logging.WARNING}
+
 # Parse a string (which may or may not be a node value), relative to a node in a system
 # Node and input arguments must be referenced to the top level of the system
-def parse(system, node, toEval = None, inputs=[], previous=[]):
+def parse(system, node, toEval = None, inputs=[], previous=[], context=None):
     
     # node and inputs are top-referenced (ie requires the absolute path within this system)
+    # inputs is a dict of path -> value used instead of the value at that path whenever it's read (the system isn't changed)
+    # A context's memo assumes every call sharing it is given the same inputs
     # variables in prefix expressions (at node value or in toEval) are relative to the node (NOT top-referenced)
     # previous tracks reference variables we've already used; prevents infinite loops
+    # context is the EvalContext for this evaluation pass; node results are memoized there (a new one is made if not given)
         
     outDict = {'system' : system, 'referenced' : [], 'output' : [], 'operators' : [], 'wellDefined' : True, 'value' : None}
     # Output system because it may be changed during evaluation by '=' operations
@@ -36,313 +77,918 @@ def parse(system, node, toEval = None, inputs=[], previous=[]):
     # operators is a list of operators used in this expression (but not evaluated sub-expressions)
     # wellDefined determines whether the information in the system plus inputs suffices to evaluate this expression
     # value is the result of evaluating the expression
+    # diagnostics are the problems found while evaluating it, if the context collects them (see EvalContext)
     
     # Find our starting place in the system
-    referenceNode = followPath(system, node)
+    if context == None: context = EvalContext()
+    firstRecord = len(context.records)
+    referenceNode = followPath(system, node, context.pathIndex(system))
+    
+    # Key inputs by shortest path, as evaluation finds them
+    overrides = {}
+    if type(inputs) == dict:
+        for path in inputs:
+            handle = context.pathIndex(system).resolve(path)
+            if handle == None: context.diagnose('invalid-input', path, 'Tried to set input %s but this wasn\'t a valid path.', path)
+            else: overrides[handle['path']] = inputs[path]
     
-    # If this wasn't a valid path, print an error and return
+    # If this wasn't a valid path, report it and return
     if referenceNode['path'] == None:
-        print('Tried to find ' + node + ' but this wasn\'t a valid path.')
-        return outDict
+        context.diagnose('invalid-path', node, 'Tried to find %s but this wasn\'t a valid path.', node)
     
-    # Evaluate toEval (preferred), or evaluate the expression at this node
-    if toEval == None: 
-        toEval = referenceNode['value']
+    else:
         
-    ########################## Case 1 ########################## 
-    ########################## Handle cases in which toEval isn't a prefix expression
+        # Evaluate toEval (preferred), or evaluate the expression (or input) at this node
+        atNode = toEval == None
+        if atNode: 
+            toEval = overrides.get(referenceNode['path'], referenceNode['value'])
+            
+        # If toEval itself isn't a string or is the empty string, return it
+        if not type(toEval) == str or toEval == '':
+            outDict['value'] = context.hold(toEval)
+        
+        # Otherwise walk the compiled form of the string from the perspective of the reference node
+        # (unless the result cache has the node's result for what it depends on now)
+        else:
+            path = referenceNode['path']
+            cached = None
+            if atNode and len(previous) == 0 and not context.resultCache == None: cached = context.cachedResult(path, toEval, system, overrides)
+            if not cached == None:
+                outDict['referenced'] = [ref for ref, digest in cached['referenced']]
+                outDict['operators'] = list(cached['operators'])
+                outDict['wellDefined'] = cached['wellDefined']
+                outDict['value'] = cached['value']
+            else:
+                loopsBefore = context.loops
+                writesBefore = context.writes
+                outDict = evaluate(system, path, compileExpression(toEval), overrides, previous, context)
+                if (atNode and len(previous) == 0 and not context.resultCache == None and context.loops == loopsBefore and
+                    context.writes == writesBefore):
+                    context.storeResult(path, toEval, outDict)
     
-    # If toEval itself isn't a string or is the empty string, return it
-    if not type(toEval) == str or toEval == '':
-        outDict['value'] = toEval
-        return outDict
+    outDict['diagnostics'] = context.records[firstRecord:len(context.records)]
+    return outDict
+
+# Walk a compiled expression (see compileExpression) relative to a node in a system
+# node must be the shortest top-referenced path to the reference node; returns the same dict as parse
+# inputs maps shortest top-referenced paths to values read in place of the system's
+# Nested expressions and references are followed with an explicit stack rather than recursion, so chains of
+# references can be as long as memory allows, and each step costs the same however deep the chain is
+def evaluate(system, node, compiled, inputs, previous, context):
     
-    # If this string starts with //, return as value
-    if toEval[0] == '//': 
-        outDict['value'] = toEval
-        return outDict
+    # previous as counts rather than a list: the nodes on the chain of references that led here
+    # A node is added when we go to evaluate something it references, and removed when that's done
+    active = {}
+    for path in previous: active[path] = active.get(path, 0) + 1
     
-    # If this string is a bool, return it
-    if toEval == 'True' or toEval == 'true':
-        outDict['value'] = True
+    # Work still waiting on the results of its parts, innermost last. Frames are dicts whose 'kind' is:
+        # list, prefix: an expression evaluating its parts one at a time ('i' is how many have been started)
+        # reference: a node we went to evaluate for a reference, waiting for the result
+        # start: an expression at a referenced node, to be started when it reaches the top
+    stack = []
+    if not context.profiler == None: context.profiler.enter(node)
+    result = startExpression(stack, system, node, compiled, active, inputs, context)
+    
+    while len(stack) > 0:
+        frame = stack[len(stack)-1]
+        kind = frame['kind']
+        
+        if kind == 'start':
+            stack.pop()
+            result = startExpression(stack, frame['system'], frame['node'], frame['compiled'], active, inputs, context)
+            continue
+        
+        if kind == 'reference':
+            stack.pop()
+            result = finishReference(frame, result, active, context)
+            continue
+        
+        # Take in the part that just finished, if any
+        parts = frame['compiled']['elements'] if kind == 'list' else frame['compiled']['args']
+        if not result == None:
+            if kind == 'list': addListElement(frame, result)
+            else: addPrefixVariable(frame, result, context)
+            
+        # Start the next part (without shifting reference node), or finish the expression if there are none left
+        if frame['i'] < len(parts):
+            frame['i'] += 1
+            result = startExpression(stack, frame['system'], frame['node'], parts[frame['i']-1], active, inputs, context)
+        else:
+            stack.pop()
+            result = finishList(frame, context) if kind == 'list' else finishPrefix(frame, context)
+    
+    if not context.profiler == None: context.profiler.exit()
+    return result
+
+# Starts evaluating a compiled expression relative to node
+# Returns the result if it can be found straight away; otherwise pushes frames for evaluate to work through and returns None
+def startExpression(stack, system, node, compiled, active, inputs, context):
+    
+    outDict = {'system' : system, 'referenced' : [], 'output' : [], 'operators' : [], 'wellDefined' : True, 'value' : None}
+    kind = compiled['kind']
+        
+    ########################## Case 1 ########################## 
+    ########################## Handle cases in which the expression isn't a prefix expression
+    
+    # Literals (bools, numbers, strings that can't be anything else) were decided at compile time
+    if kind == 'value':
+        outDict['value'] = compiled['value']
+        outDict['wellDefined'] = compiled['wellDefined']
         return outDict
-    if toEval == 'False' or toEval == 'false':
-        outDict['value'] = False
+    if kind == 'constant':
+        outDict['value'] = compiled['value']
+        outDict['operators'] = list(compiled['operators'])
         return outDict
     
-    # If the string is a number, return it
-    try:
-        if float(toEval)*0 == 0 : 
-            outDict['value'] =float(toEval)
-            return outDict
-    except: pass
-
-    # If the entire string is a list, interpret as a list of strings and evaluate each
-    # Use findParentheticalSubstring to make sure it's the whole string
-    # Do not change the reference node when evaluating
-    if toEval[0] == '[':
+    # If the entire string is a list, evaluate each element
+    # The value we will output will be a list
+    if kind == 'list':
+        outDict['value'] = []
+        stack.append({'kind' : 'list', 'node' : node, 'compiled' : compiled, 'system' : system, 'i' : 0, 'out' : outDict,
+                      'referenced' : OrderedSet(), 'output' : OrderedSet(), 'operators' : OrderedSet()})
+        return None
+    
+    # Try to evaluate the string as a path through the graph such as var1.var2...key
+    # This is the only case where the reference node changes
+    if kind == 'symbol':
         
-        # Find corresponding closed bracket
-        listString = findParentheticalSubstring(toEval)
+        # Get an absolute path to the variable (sum of absolute node and relative variable paths)
+        # and clean it up to make it non-redundant
+        profiler = context.profiler
+        if profiler == None: handle = context.pathIndex(system).resolveFrom(node, compiled['text'])
+        else:
+            start = profiler.clock()
+            handle = context.pathIndex(system).resolveFrom(node, compiled['text'])
+            profiler.lookup(profiler.clock() - start)
         
-        # Do analysis if all of toEval is a list (otherwise don't know what to return)
-        if len(listString[0]) == len(toEval):
+        # If this returned a valid path, evaluate whatever is there and return it
+        if not handle == None:
+            path = handle['path']
             
-            # The value we will output will be a list
-            outDict['value'] = []
-            
-            # Use commas to denote elements of the list (so sub-expressions can't have them)
-            splitString = toEval.split(',')
-            for elem in splitString:
+            # Prevent infinite loops
+            if not path in active:
                 
-                # Remove leading and trailing characters
-                while elem[0] in ['[', ' '] : elem = elem[1:len(elem)] 
-                while elem[len(elem)-1] in [']', ' '] : elem = elem[0:len(elem)-1] 
+                # Reuse this node's result if it's already been evaluated in this pass
+                memoized = context.memo.get(path)
+                if not memoized == None:
+                    if not profiler == None: profiler.hit(path)
+                    outDict['referenced'] = [path]
+                    outDict['wellDefined'] = memoized['wellDefined']
+                    outDict['value'] = memoized['value']
+                    return outDict
                 
-                # Recursively evaluate this element and merge with outDict
-                evaluatedElement = parse(system, node, elem, inputs, previous)
-                outDict['system'] = evaluatedElement['system']
-                outDict['referenced'] = removeRedundantValues(outDict['referenced'] + evaluatedElement['referenced'])
-                outDict['output'] = removeRedundantValues(outDict['output'] + evaluatedElement['output'])
-                outDict['operators'] = removeRedundantValues(outDict['operators'] + evaluatedElement['operators'])
-                outDict['wellDefined'] = outDict['wellDefined'] and evaluatedElement['wellDefined']
-                outDict['value'].append(evaluatedElement['value'])
-        
-        # Once we've recursively evaluated each element, return result
-        return outDict
+                # Or a stored result, if nothing it depends on has changed since
+                value = inputs[path] if path in inputs else handle['value']
+                isFormula = type(value) == str and not value == ''
+                if isFormula and not context.resultCache == None:
+                    cached = context.cachedResult(path, value, system, inputs)
+                    if not cached == None:
+                        if not profiler == None: profiler.hit(path)
+                        outDict['referenced'] = [path]
+                        outDict['wellDefined'] = cached['wellDefined']
+                        outDict['value'] = cached['value']
+                        return outDict
+                
+                # Evaluate whatever we find from the perspective of the new node, with this node on the chain
+                active[node] = active.get(node, 0) + 1
+                reference = {'kind' : 'reference', 'path' : path, 'caller' : node, 'loopsBefore' : context.loops,
+                             'writesBefore' : context.writes, 'formula' : value if isFormula else None}
+                if not profiler == None: profiler.enter(path, True)
+                
+                # If the node's value (or the input given for it) isn't a string or is the empty string, that's its result
+                if not isFormula:
+                    outDict['value'] = context.hold(value)
+                    return finishReference(reference, outDict, active, context)
+                
+                stack.append(reference)
+                stack.append({'kind' : 'start', 'node' : path, 'compiled' : compileExpression(value), 'system' : system})
+                return None
             
+            # If on this branch we've evaluated using this reference node, error to prevent loop
+            else:
+                context.loops += 1
+                if not profiler == None: profiler.loop(path)
+                context.diagnose('loop', node, 'Evaluating %s would lead to loop', path)
+                return outDict
+        
+        # Not a path, so fall back to reading the string as a prefix expression
+        compiled = compiled['fallback']
+        kind = compiled['kind']
+        
+    ########################## Case 2 ##########################
+    ##### Evaluate as a prefix notation expression 'operator var1 var2... varN'
     
-    # Try to evaluate the string as a path through the graph such as var1.var2...key
-    # This is the only case where the reference node changes
+    # If we've gotten to this point, default to the expression not being well-defined
+    outDict['wellDefined'] = False
     
-    # Get an absolute path to the variable (sum of absolute node and relative variable paths)
-    referenceNodeAbsolutePath = referenceNode['path']
-    thisVarAbsolutePath = referenceNodeAbsolutePath + '.' + toEval
+    # If we couldn't find an operator, return the string we were evaluating
+    if kind == 'text':
+        outDict['value'] = compiled['value']
+        return outDict
+    
+    thisOperator = compiled['operator']
+    
+    # A subexpression shared with other formulas (see optimizeSystem) may have been evaluated already in this pass
+    shared = None
+    if not context.shared == None and compiled['text'] in context.shared:
+        shared = context.sharedKey(system, node, compiled)
+        sharedResult = context.subexpressions.get(shared)
+        if not sharedResult == None:
+            outDict['referenced'] = list(sharedResult['referenced'])
+            outDict['operators'] = list(sharedResult['operators'])
+            outDict['wellDefined'] = sharedResult['wellDefined']
+            outDict['value'] = sharedResult['value']
+            return outDict
+    
+    # Track output variable: whether we are expecting one (None) or not (False)
+    outputVarPath = False
+    if thisOperator == '=' : outputVarPath = None
+    
+    # Collect referenced, output and operators in ordered sets, and store them in outDict once we're done
+    # Keep a list for each var1...varN of whether it is evaluable and what its value is 
+    stack.append({'kind' : 'prefix', 'node' : node, 'compiled' : compiled, 'system' : system, 'i' : 0, 'out' : outDict,
+                  'referenced' : OrderedSet(), 'output' : OrderedSet(), 'operators' : OrderedSet([thisOperator]),
+                  'variableEvaluable' : [], 'variableValues' : [], 'outputVarPath' : outputVarPath,
+                  'shared' : shared, 'loopsBefore' : context.loops, 'writesBefore' : context.writes})
+    return None
 
-    # Clean up this path to make it non-redundant
-    pathResult = followPath(system, thisVarAbsolutePath)
+# A node evaluated for a reference has its result: take it off the chain and report it as a reference
+def finishReference(frame, result, active, context):
     
-    # If this returned a valid path, evaluate whatever is there and return it
-    if not pathResult['path'] == None:
-        
-        # Prevent infinite loops
-        if not pathResult['path'] in previous:
+    caller = frame['caller']
+    active[caller] -= 1
+    if active[caller] == 0: del active[caller]
+    if not context.profiler == None: context.profiler.exit()
+    
+    # Memoize it (and store it, if it's a formula), unless it ran into a loop (so depends on how we got here) or set
+    # something, here or in anything it referenced (so reusing it would skip the write)
+    cacheable = context.loops == frame['loopsBefore'] and context.writes == frame['writesBefore']
+    context.remember(frame['path'], result, cacheable)
+    if cacheable and not context.resultCache == None and not frame['formula'] == None:
+        context.storeResult(frame['path'], frame['formula'], result)
+    
+    # There was exactly one variable referenced here: the one we evaluated
+    result['referenced'] = [frame['path']]
+    
+    # Don't pass on output or operators because we changed reference nodes
+    result['output'] = []
+    result['operators'] = []
+    return result
 
-            # Recursively evaluate whatever we find from the perspective of the new node
-            result = parse(system, pathResult['path'], None, inputs, previous+[referenceNode['path']])
-            
-            # There was exactly one variable referenced here: the one we evaluated
-            result['referenced'] = [pathResult['path']]
-            
-            # Don't pass on output or operators because we changed reference nodes
-            result['output'] = []
-            result['operators'] = []
-            
-            # We've evaluated this variable, so return the result
-            return result
+# Merge an evaluated element into a list frame
+def addListElement(frame, evaluatedElement):
+    outDict = frame['out']
+    frame['system'] = evaluatedElement['system']
+    outDict['system'] = evaluatedElement['system']
+    frame['referenced'].update(evaluatedElement['referenced'])
+    frame['output'].update(evaluatedElement['output'])
+    frame['operators'].update(evaluatedElement['operators'])
+    outDict['wellDefined'] = outDict['wellDefined'] and evaluatedElement['wellDefined']
+    outDict['value'].append(evaluatedElement['value'])
+
+# Once we've evaluated each element, return result
+def finishList(frame, context):
+    outDict = frame['out']
+    outDict['referenced'], outDict['output'], outDict['operators'] = list(frame['referenced']), list(frame['output']), list(frame['operators'])
+    if context.vectorize or context.lazy: outDict['value'] = context.hold(outDict['value'])
+    return outDict
+
+# Merge an evaluated variable (or nested expression) into a prefix frame
+def addPrefixVariable(frame, sectionResult, context):
+    
+    # If any values were set while evaluating this expression, use them in the future
+    system = sectionResult['system']
+    frame['system'] = system
+    frame['out']['system'] = system
+    
+    # If we're still looking for the output variable, find the path and store as output variable path
+    # Nested prefix expressions can't be set
+    if frame['outputVarPath'] == None:
+        thisVar = frame['compiled']['variables'][frame['i']-1]
+        if thisVar == None: frame['outputVarPath'] = False
+        elif context.profiler == None:
+            frame['outputVarPath'] = followPath(system, frame['node'] + '.' + thisVar, context.pathIndex(system))['path']
+        else:
+            start = context.profiler.clock()
+            frame['outputVarPath'] = followPath(system, frame['node'] + '.' + thisVar, context.pathIndex(system))['path']
+            context.profiler.lookup(context.profiler.clock() - start)
+    outputVarPath = frame['outputVarPath']
+    
+    # Incorporate prefix notation params from nested expressions and varaibles
+    if not frame['compiled']['operator'] == '=' or (type(outputVarPath) == str and not outputVarPath in sectionResult['referenced']):
+        frame['referenced'].update(sectionResult['referenced'])
+    frame['output'].update(sectionResult['output'])
+    frame['operators'].update(sectionResult['operators'])
+    
+    # Store outputs from this evaluation into the two lists
+    frame['variableEvaluable'].append(sectionResult['wellDefined'])
+    frame['variableValues'].append(sectionResult['value'])
+
+########################## Evaluate the Expression ##########################
+##### All variables have been assessed, so evaluate this bit of prefix notation based on the operator
+##### We have one operator, a list of variables, and a list indicating whether vars are well-defined      
+def finishPrefix(frame, context):
+    
+    outDict = frame['out']
+    system = frame['system']
+    toEval = frame['compiled']['text']
+    thisOperator = frame['compiled']['operator']
+    variableEvaluable = frame['variableEvaluable']
+    variableValues = frame['variableValues']
+    outputVarPath = frame['outputVarPath']
+        
+    if False in variableEvaluable:
+        context.diagnose('not-evaluable', frame['node'], 'part(s) of %s not evaluable', toEval)
+    
+    if not context.profiler == None: start = context.profiler.clock()
         
-        # If on this branch we've evaluated using this reference node, error to prevent loop
+    # If the operator is equals, set the output variable to whatever the remaining var(s) evaluated as
+    # And return that same value
+    if thisOperator == '=':                
+            
+        # If we can evaluate all non-outputs, this is evaluable. Otherwise it's not
+        if not False in variableEvaluable and len(variableValues) == 2:
+            try:
+                outputValue = variableValues[1] # Second variable is the output
+                outDict['wellDefined'] = True
+                frame['output'].add(outputVarPath)
+                
+                system = writeValue(system, outputVarPath, outputValue, context)
+                outDict['value'] = outputValue
+            except:
+                context.diagnose('set-failed', frame['node'], 'Problem setting %s to %s', outputVarPath, outputValue)
+    
+    result = {'value':None, 'wellDefined':False}
+    
+    # One lookup says how to apply the operator (see operatorRegistry)
+    entry = operatorRegistry.get(thisOperator)
+    typing = None if entry == None else entry['typing']
+    
+    # Unary operator must have exactly one argument
+    if typing == 'sets' and entry['arity'] == 1:
+        if len(variableValues) == 1:
+            result = operateEntry(entry, variableEvaluable, variableValues, context, frame['node'])
         else:
-            print('> ERROR: Evaluating ' + pathResult['path'] + ' would lead to loop')
-            return outDict
+            context.diagnose('arity', frame['node'], 'operator %s needs exactly one argument; was given %s', thisOperator, variableValues)
         
+    # (biop A B C ...) gives (A biop B) op C ...
+    elif typing == 'numbers':
+        result = operateEntry(entry, variableEvaluable, variableValues, context, frame['node'])
+        
+    elif typing == 'sets':
+        if not False in variableEvaluable:
+            result['value'] = entry['func'](variableValues[0], variableValues[1])
+            result['wellDefined'] = True
+    
+    if not context.profiler == None: context.profiler.operator(thisOperator, context.profiler.clock() - start)
+    
+    outDict['value'] = result['value']
+    outDict['wellDefined'] = result['wellDefined']
+    outDict['referenced'], outDict['output'], outDict['operators'] = list(frame['referenced']), list(frame['output']), list(frame['operators'])
+    outDict['system'] = system
+    if not frame['shared'] == None and context.loops == frame['loopsBefore'] and context.writes == frame['writesBefore']:
+        context.shareResult(frame['shared'], outDict)
+    return outDict
 
-    ########################## Case 2 ##########################
-    ##### Evaluate as a prefix notation expression 'operator var1 var2... varN'
+# Turn a formula string into a reusable expression tree, cached by formula text
+# Each tree is a dict whose 'kind' says how evaluate should treat it:
+    # value: a literal (bool, number, ...) returned as is
+    # list: a [a, b, ...] list whose 'elements' are compiled trees
+    # symbol: may be a path relative to the reference node; if not, evaluate 'fallback' instead
+    # prefix: 'operator' applied to compiled 'args'; 'variables' has the text of each arg that isn't a nested expression
+    # text: a string that isn't anything we know how to evaluate
+    # constant: a prefix expression of literals, evaluated when compiled: its 'value' and the 'operators' it used
+    #           (the expression itself is kept as 'prefix')
+# Compiled trees are shared between callers and must not be modified
+def compileExpression(toEval):
     
-    # If we've gotten to this point, default to the expression not being well-defined
-    outDict['wellDefined'] = False
+    # Reuse the tree if we've seen this formula recently
+    with compileLock:
+        compiled = compileCache.get(toEval)
+        if compiled != None:
+            compileCache.move_to_end(toEval)
+            return compiled
+    
+    # Compile without the lock, since nested expressions are compiled (and cached) the same way
+    compiled = compileString(toEval)
+    
+    # Store, evicting the least recently used formula if the cache is full
+    with compileLock:
+        compileCache[toEval] = compiled
+        if len(compileCache) > compileCacheSize: compileCache.popitem(last=False)
+    return compiled
+
+# Compile a (non-empty) string the same way parse would read it, without evaluating anything
+def compileString(toEval):
+    
+    # If this string is a bool, return it
+    if toEval == 'True' or toEval == 'true': return {'kind' : 'value', 'value' : True, 'wellDefined' : True}
+    if toEval == 'False' or toEval == 'false': return {'kind' : 'value', 'value' : False, 'wellDefined' : True}
+    
+    # If the string is a number, return it
+    try:
+        if float(toEval)*0 == 0 : return {'kind' : 'value', 'value' : float(toEval), 'wellDefined' : True}
+    except: pass
+    
+    # If the entire string is a list, interpret as a list of strings and compile each
+    # Use findParentheticalSubstring to make sure it's the whole string
+    if toEval[0] == '[':
+        
+        # Don't know what to return if only part of the string is a list
+        listString = findParentheticalSubstring(toEval)
+        if not len(listString[0]) == len(toEval): return {'kind' : 'value', 'value' : None, 'wellDefined' : True}
+        
+        # Use commas to denote elements of the list (so sub-expressions can't have them)
+        elements = []
+        for elem in toEval.split(','):
+            
+            # Remove leading and trailing characters; trailing commas are invisible
+            elem = elem.lstrip('[ ').rstrip('] ')
+            if not elem == '': elements.append(compileExpression(elem))
+        
+        return {'kind' : 'list', 'elements' : elements}
+    
+    # Variable names can't contain spaces, so only a string without them may be a path
+    if not ' ' in toEval:
+        return {'kind' : 'symbol', 'text' : toEval, 'fallback' : compilePrefix(toEval)}
+    
+    return compilePrefix(toEval)
 
+# Compile a string as a prefix notation expression 'operator var1 var2... varN'
+def compilePrefix(toEval):
+    
+    # If we can't find an operator, evaluating gives back the string itself
+    notPrefix = {'kind' : 'text', 'value' : toEval}
+    
     # Initialize remainder, which will act as the part of the string we haven't processed
     remainder = toEval
     
     # If it's a string and starts and ends with parens, remove pairs of parens
-    while remainder[0]=='(' and remainder[len(remainder)-1]==')':
-
-        # Remove start and end parentheses
+    while len(remainder) > 1 and remainder[0]=='(' and remainder[len(remainder)-1]==')':
         remainder = remainder[1:len(remainder)-1]
         
     # Now remove start and end spaces
-    while remainder[0]== ' ' : remainder = remainder[1:len(remainder)]
-    while remainder[len(remainder)-1]== ' ' : remainder[0:len(remainder)-1]
+    remainder = remainder.strip(' ')
+    if remainder == '': return notPrefix
+    
+    # Treat remainder as 'operator var1 var2... varN' and get operator; remove trailing commas from operator
+    thisOperator = remainder.split(' ')[0].rstrip(',')
+    if not thisOperator in operatorRegistry: return notPrefix
+    
+    # Remove operator from remainder
+    remainder = remainder[len(thisOperator)+1 : len(remainder)]
+    
+    # Compile each variable. Don't simply split by ' ' because variables may be expressions
+    args = []
+    variables = []
+    while True:
         
-    # All the operators we know how to deal with
-    operators = ['+', '-', '*', '/', '%', '==', '<', '<=', '>', '>=', '=', 'union', 'intersection', 'sum', 'pi', 'dot']
+        # Remove leading spaces and leftover commas
+        remainder = remainder.lstrip(' ,')
+        if remainder == '': break
         
-    # Treat remainder as 'operator var1 var2... varN' and get operator
-    thisOperator = remainder.split(' ')[0]
+        # If remainder starts with open parentheses, compile up to the corresponding closed parentheses
+        if remainder[0] == '(':
+            remainderSplit = findParentheticalSubstring(remainder)
+            args.append(compileExpression(remainderSplit[0]))
+            variables.append(None)
+            remainder = remainder[len(remainderSplit[0]):len(remainder)]
+            
+        # Otherwise get the variable, remove it from remainder, and remove trailing commas
+        else:
+            thisVar = remainder.split(' ')[0]
+            remainder = remainder[len(thisVar) + 1 : len(remainder)]
+            thisVar = thisVar.rstrip(',')
+            args.append(compileExpression(thisVar))
+            variables.append(thisVar)
+        
+    return foldConstant({'kind' : 'prefix', 'text' : toEval, 'operator' : thisOperator, 'args' : args, 'variables' : variables})
+
+# A compiled prefix expression whose arguments are all literals (or folded themselves) evaluated now, as a
+# constant tree, if that gives a well-defined number or bool without any problems; otherwise compiled as it is
+def foldConstant(compiled):
     
-    # Remove trailing commas from operator
-    while thisOperator[len(thisOperator)-1] == ',' : thisOperator = thisOperator[0:len(thisOperator)-1]
+    if compiled['operator'] == '=': return compiled
+    for arg in compiled['args']:
+        if not arg['kind'] in ('value', 'constant'): return compiled
     
-    # If we looked for an operator and found it, evaluate as a prefix notation expression
-    if thisOperator in operators:
+    context = EvalContext(diagnostics='collect')
+    try: result = evaluate({}, '', compiled, {}, [], context)
+    except Exception: return compiled
+    if len(context.records) > 0 or not result['wellDefined'] or not type(result['value']) in (float, int, bool): return compiled
+    return {'kind' : 'constant', 'text' : compiled['text'], 'value' : result['value'], 'operators' : result['operators'],
+            'prefix' : compiled}
 
-        # Remove operator from remainder, and store in outDict
-        remainder = remainder[len(thisOperator)+1 : len(remainder)]
-        outDict['operators'].append(thisOperator)
+# Holds state shared by everything evaluated in one pass (eg one call to parse)
+# memo maps top-referenced node paths to {'value', 'wellDefined'} so each node is evaluated once per pass
+# If vectorize, numeric lists are held as NumPy arrays and operators on them run vectorized
+# If copyOnWrite, '=' never changes a system in place: it makes a new version sharing everything it didn't set
+# (see setValue), and parse returns the new version as 'system'
+# If lazy, lists are held as LazyLists, so operators on them give LazyLists that work out each element when it's
+# needed, and reductions (sum, pi, cardinality, dot) stream through them; problems with elements (eg dividing by zero)
+# only come up when the elements are used
+# If profiler is a Profiler, it's told about every node evaluated, memo hit, path lookup and operator applied
+# If shared is a set of subexpression texts (see optimizeSystem), each of them is evaluated once per pass for each
+# set of paths its variables lead to, and its result reused wherever else it appears with the same paths
+# If resultCache is a ResultCache, results of formula nodes are stored in it, and a node whose formula and
+# referenced values haven't changed since it was stored isn't evaluated again (even in another process)
+# diagnostics says what to do with problems found while evaluating (loops, parts that aren't evaluable, ...):
+    # 'collect': keep them in records as dicts of code (see diagnosticLevels), path (the node) and message,
+    #            and give parse results the ones found while evaluating them as 'diagnostics'
+    # 'log': send them to logger; messages are only formatted if the logger will emit them
+    # 'drop': ignore them
+class EvalContext:
+    
+    def __init__(self, memo=None, vectorize=False, copyOnWrite=False, profiler=None, diagnostics='log', lazy=False,
+                 resultCache=None, shared=None):
         
-        # Treat remainder as 'var1 var2... varN' and evaluate each variable
-        # Keep a list for each var1...varN of whether it is evaluable and what its value is 
-        variableEvaluable = []
-        variableValues = []
+        # memo may be passed in to reuse (and keep up to date) results stored elsewhere
+        self.memo = {} if memo == None else memo
         
-        # Track output variable: whether we are expecting one (None) or not (False)
-        outputVarPath = False
-        if thisOperator == '=' : outputVarPath = None
+        if vectorize and numpy == None: raise ImportError('vectorized evaluation needs numpy')
+        self.vectorize = vectorize
+        if vectorize and lazy: raise ValueError('lists can be vectorized or lazy, but not both')
+        self.lazy = lazy
+        self.copyOnWrite = copyOnWrite
         
-        # Loop over the remainder while it's not empty. Don't simply split by ' ' because variables may be expressions
-        while not remainder == '':
-            
-            # Remove leading spaces and leftover commas
-            while remainder[0] == ' ' or  remainder[0] == ',' : remainder = remainder[1:len(remainder)]
-            
-            # If remainder starts with open parentheses
-            if remainder[0] == '(':
-                
-                # Find substring to corresponding closed parentheses. remainderSplit[0] is this substring, remainderSplit[1] is the rest
-                remainderSplit = findParentheticalSubstring(remainder)
-                
-                # Recursively evaluate that whole expression without shifting reference node
-                sectionResult = parse(system, node, remainderSplit[0], inputs, previous) 
-                   
-                # Set remainder to the rest of the string (after closed parens and ' ')
-                remainder = remainder[len(remainderSplit[0]):len(remainder)]
-                    
-                # Nested prefix expressions can't be set
-                if outputVarPath == None:
-                    outputVarPath = False
-     
-            # If the remainder does not start with open parens, evaluate it recursively
-            else:
-                
-                # Get the variable and remove from remainder
-                thisVar = remainder.split(' ')[0]
-                remainder = remainder[len(thisVar) + 1 : len(remainder)]
-                
-                # Remove trailing commas
-                while thisVar[len(thisVar)-1] == ',' : thisVar = thisVar[0:len(thisVar)-1]
-                
-                # Recursively evaluate whatever we've found, maintaining this as reference node
-                sectionResult = parse(system, node, thisVar, inputs, previous)
+        # Paths read by each node we've evaluated, reversed: path -> nodes that read it
+        self.readers = {}
+        
+        # Number of loops detected so far; results computed while this changed aren't memoized
+        self.loops = 0
+        
+        # Number of values set so far; shared subexpressions whose evaluation set anything aren't kept
+        self.writes = 0
+        
+        # PathIndex of the system being evaluated, made when first needed
+        self.paths = None
+        
+        # writerIndex of every '=' in that system (see systemWriters), made when first needed and dropped when
+        # something is set that may change it
+        self.writers = None
+        
+        # If a list, every '=' appends (path, old value) so the write can be undone
+        self.journal = None
+        
+        # Checked before every call to it, so evaluating without one costs (almost) nothing extra
+        self.profiler = profiler
+        
+        if not diagnostics in ('collect', 'log', 'drop'): raise ValueError('diagnostics must be collect, log or drop')
+        self.diagnostics = diagnostics
+        self.records = []
+        
+        # Digests (see valueDigest) of memoized values, made when first needed
+        self.resultCache = resultCache
+        self.digests = {}
+        
+        # Nodes whose stored results were found to be out of date in this pass (they'll be evaluated and stored again)
+        self.outdated = set()
+        
+        # Texts of subexpressions to evaluate once wherever they read the same paths, and their results so far,
+        # keyed by sharedKey
+        self.shared = shared
+        self.subexpressions = {}
+    
+    # The PathIndex for system, making a new one if the system isn't the one we've indexed
+    def pathIndex(self, system):
+        if self.paths == None or not self.paths.system is system:
+            self.paths = PathIndex(system)
+            self.writers = None
+        return self.paths
+    
+    # The writerIndex of every '=' in system
+    def writerIndex(self, system):
+        paths = self.pathIndex(system)
+        if self.writers == None: self.writers = systemWriters(system, paths)
+        return self.writers
+    
+    # Report a problem found while evaluating the node at path
+    # message is a %-style format for args, and is only formatted if the diagnostic is kept
+    def diagnose(self, code, path, message, *args):
+        if self.diagnostics == 'drop': return
+        if self.diagnostics == 'collect':
+            self.records.append({'code' : code, 'path' : path, 'message' : message % args})
+        else:
+            level = diagnosticLevels[code]
+            if logger.isEnabledFor(level): logger.log(level, message, *args, extra={'code' : code, 'path' : path})
+    
+    # Hold a value read from a system or made by a list expression the way this context evaluates lists
+    def hold(self, value):
+        if self.vectorize: return self.asArray(value)
+        if self.lazy and isList(value): return LazyList(value)
+        return value
+    
+    # Hold value as an array if it's a list of numbers; anything else is returned as it is
+    # LazyLists over memoryviews of doubles (as kstore loads them) become arrays over the same memory
+    def asArray(self, value):
+        if type(value) is LazyList and type(value.source) is memoryview and value.items == None:
+            if value.source.format == 'd': return numpy.frombuffer(value.source, dtype=float)
+            return numpy.asarray(value.source, dtype=float)
+        if type(value) is array.array and len(value) > 0: return numpy.asarray(value, dtype=float)
+        if type(value) is list and len(value) > 0:
+            for elem in value:
+                if not (type(elem) is float or type(elem) is int): return value
+            return numpy.array(value, dtype=float)
+        return value
+    
+    # Record what a node referenced, and memoize its result if it doesn't depend on how we reached it
+    def remember(self, path, result, cacheable=True):
+        for referenced in result['referenced']:
+            self.readers.setdefault(referenced, set()).add(path)
+        if cacheable: self.memo[path] = {'value' : result['value'], 'wellDefined' : result['wellDefined']}
+    
+    # Store the result of the node at path, evaluated from formula, in the result cache
+    # Its referenced values must be memoized (as they are once it's been evaluated), and the system it was evaluated
+    # in must be the one we've indexed
+    # Where each symbol led is stored with it, so the result isn't used once a symbol leads somewhere else (or
+    # somewhere at all, if it wasn't a path when the result was stored)
+    def storeResult(self, path, formula, result):
+        referenced = []
+        for ref in result['referenced']:
+            if not ref in self.memo: return
+            if not ref in self.digests: self.digests[ref] = valueDigest(self.memo[ref]['value'])
+            referenced.append((ref, self.digests[ref]))
+        resolved = self.symbolPaths(self.paths.system, path, compileExpression(formula))
+        self.resultCache.put(self.resultCache.key(path, formula), {'referenced' : referenced, 'resolved' : resolved,
+                             'value' : result['value'], 'wellDefined' : result['wellDefined'], 'operators' : result['operators']})
+    
+    # The stored result of the node at path with this formula, if everything it referenced is still the same;
+    # otherwise None. Referenced formula nodes are checked against their own stored results (not evaluated),
+    # and each node that checks out is memoized
+    def cachedResult(self, path, formula, system, inputs):
+        
+        if path in self.outdated: return None
+        paths = self.pathIndex(system)
+        
+        # Nodes being checked (innermost last), and their stored results
+        toCheck = [(path, formula)]
+        entries = {}
+        while len(toCheck) > 0:
+            node, nodeFormula = toCheck[len(toCheck)-1]
+            entry = entries.get(node)
+            if entry == None:
+                entry = None if node in self.outdated else self.resultCache.get(self.resultCache.key(node, nodeFormula))
+                if entry == None: return self.outdatedResult(toCheck)
+                if not entry.get('resolved') == self.symbolPaths(system, node, compileExpression(nodeFormula)):
+                    return self.outdatedResult(toCheck)
+                entries[node] = entry
             
-                # If this is the first variable after parens, add to output
-                if outputVarPath == None:
-                    
-                    # Find the path and store as output variable path
-                    pathResult = followPath(system, node +'.'+ thisVar)
-                    outputVarPath = pathResult['path']
+            # Check what it referenced in order, first checking any formula node we don't have a value for yet
+            waiting = False
+            for ref, digest in entry['referenced']:
+                if ref in self.memo:
+                    if not ref in self.digests: self.digests[ref] = valueDigest(self.memo[ref]['value'])
+                    if self.digests[ref] == digest: continue
+                    return self.outdatedResult(toCheck)
+                handle = paths.resolve(ref)
+                if handle == None: return self.outdatedResult(toCheck)
+                value = inputs[ref] if ref in inputs else handle['value']
+                if type(value) == str and not value == '':
                     
-            # If any values were set while evaluating this expression, use them in the future
-            system = sectionResult['system']
-            outDict['system'] = system
-            
-            # Incorporate prefix notation params from nested expressions and varaibles
-            if not thisOperator == '=' or (type(outputVarPath) == str and not outputVarPath in sectionResult['referenced']):
-                outDict['referenced'] = removeRedundantValues(outDict['referenced'] + sectionResult['referenced'])
-            outDict['output'] = removeRedundantValues(outDict['output'] + sectionResult['output'])
-            outDict['operators'] = removeRedundantValues(outDict['operators'] + sectionResult['operators'])
+                    # A stored result that (now) references itself can't be trusted
+                    if ref in entries: return self.outdatedResult(toCheck)
+                    toCheck.append((ref, value))
+                    waiting = True
+                    break
+                if not valueDigest(self.hold(value)) == digest: return self.outdatedResult(toCheck)
+            if waiting: continue
             
-            # Store outputs from this evaluation into the two lists
-            variableEvaluable.append(sectionResult['wellDefined'])
-            variableValues.append(sectionResult['value'])
-                
-        ########################## Evaluate the Expression ##########################
-        ##### All variables have been assessed, so evaluate this bit of prefix notation based on the operator
-        ##### We have one operator, a list of variables, and a list indicating whether vars are well-defined      
-            
-        if False in variableEvaluable:
-            print('> Warning: part(s) of ' + toEval + ' not evaluable')
-            
-        # If the operator is equals, set the output variable to whatever the remaining var(s) evaluated as
-        # And return that same value
-        if thisOperator == '=':                
-                
-            # If we can evaluate all non-outputs, this is evaluable. Otherwise it's not
-            if not False in variableEvaluable and len(variableValues) == 2:
-                try:
-                    outputValue = variableValues[1] # Second variable is the output
-                    outDict['wellDefined'] = True
-                    outDict['output'] = removeRedundantValues(outDict['output'] + [outputVarPath])
-                    system = setValue(system, outputVarPath, outputValue)
-                    outDict['value'] = outputValue
-                except:
-                    print('> ERROR: Problem setting ' + str(outputVarPath) + ' to ' + str(outputValue))
-        
-        # binaryOpsDict stores operator characters with their functions
-        binaryOpsNumsDict = {'+':plus, 
-                   '-':minus,
-                   '*':multiply,
-                   '/':divide,
-                   '%':modulus,
-                   '==':isEqual,
-                   '<':lessThan,
-                   '<=':lessThanOrEqual,
-                   '>':greaterThan,
-                   '>=':greaterThanOrEqual
-                   }
-                   
-        binaryOpsSetsDict = {      
-                   'union':union,
-                   'intersection':intersection,
-                   'dot':dot
-                   }
-        
-        unaryOpsSetsDict = {'sum':sumfn,
-                   'sigma':sumfn,
-                   'pi':pifn,
-                   'cardinality':cardinality
-                   }
-        
-        result = {'value':None, 'wellDefined':False}
-        
-        # Unary operator must have exactly one argument
-        if thisOperator in unaryOpsSetsDict:     
-            if len(variableValues) == 1:
-                result = operate(unaryOpsSetsDict, thisOperator, 1, variableEvaluable, variableValues)
-            else:
-                print('> ERROR: operator ' + thisOperator + ' needs exactly one argument; was given ' + str(variableValues))
-            
-        # (biop A B C ...) gives (A biop B) op C ...
-        elif thisOperator in binaryOpsNumsDict:   
-            result = operate(binaryOpsNumsDict, thisOperator, 2, variableEvaluable, variableValues)
-            
-        elif thisOperator in binaryOpsSetsDict:   
-            if not False in variableEvaluable:
-                func = binaryOpsSetsDict[thisOperator]
-                result['value'] = func(variableValues[0], variableValues[1])
-                result['wellDefined'] = True
-        
-        outDict['value'] = result['value']
-        outDict['wellDefined'] = result['wellDefined']
-                    
-        # Needs to:
-            # establish whether we have enough values defined to calculate
-            # If possible, calculate value
+            # Everything it read is the same, so its result is too
+            toCheck.pop()
+            self.remember(node, {'referenced' : [ref for ref, digest in entry['referenced']], 'value' : entry['value'],
+                                 'wellDefined' : entry['wellDefined']})
+            if node == path: return entry
+    
+    # Give up checking the nodes in toCheck: each one's stored result depends on the next, and the last is out of date
+    def outdatedResult(self, toCheck):
+        for node, nodeFormula in toCheck: self.outdated.add(node)
+        return None
+    
+    # What identifies a shared subexpression evaluated at node: its text, and the path each variable in it leads to
+    def sharedKey(self, system, node, compiled):
+        return tuple([compiled['text']] + [path for text, path in self.symbolPaths(system, node, compiled)])
+    
+    # Where each symbol (text that may be a path) in a compiled expression leads from node, as a list of
+    # (text, shortest path), with None as the path of a symbol that isn't a path
+    def symbolPaths(self, system, node, compiled):
+        paths = self.pathIndex(system)
+        resolved = []
+        toVisit = [compiled]
+        while len(toVisit) > 0:
+            compiled = toVisit.pop()
+            if compiled['kind'] == 'symbol':
+                handle = paths.resolveFrom(node, compiled['text'])
+                resolved.append((compiled['text'], None if handle == None else handle['path']))
+                if handle == None: toVisit.append(compiled['fallback'])
+            elif compiled['kind'] == 'list': toVisit.extend(compiled['elements'])
+            elif compiled['kind'] == 'prefix': toVisit.extend(compiled['args'])
+        return resolved
+    
+    # Keep the result of a shared subexpression for the rest of the pass, until something it read is set
+    def shareResult(self, key, result):
+        for referenced in result['referenced']:
+            self.readers.setdefault(referenced, set()).add(key)
+        self.subexpressions[key] = {'referenced' : result['referenced'], 'operators' : result['operators'],
+                                    'wellDefined' : result['wellDefined'], 'value' : result['value']}
+    
+    # Forget results that depend on path, which has just been set
+    # If subtree, the node at path was or is a dict, so results of nodes inside it are forgotten too
+    def invalidate(self, path, subtree=False):
+        
+        # The node itself, and every dict containing it (their values contain it)
+        pathSplit = path.split('.')
+        toVisit = ['.'.join(pathSplit[0:i]) for i in range(1, len(pathSplit)+1)]
+        if subtree: toVisit = toVisit + [key for key in self.memo if key.startswith(path + '.')]
+        
+        # Then everything that read any of those, and so on
+        seen = set(toVisit)
+        while len(toVisit) > 0:
+            stale = toVisit.pop()
+            self.memo.pop(stale, None)
+            self.digests.pop(stale, None)
+            self.subexpressions.pop(stale, None)
+            for reader in self.readers.get(stale, []):
+                if not reader in seen:
+                    seen.add(reader)
+                    toVisit.append(reader)
 
-    # If we haven't evaluated this (including we couldn't find an operator corresponding to it),
-    # return toEval as the string we were evaluating or the string at this node/key location
-    else:
-        outDict['value'] = toEval
+# Collects where evaluation time goes; pass one to EvalContext(profiler=...) and read it afterwards
+# nodes maps top-referenced node path -> dict of:
+    # count: times the node was evaluated
+    # hits, misses: times a reference to it found its result memoized or had to evaluate it
+    # loops: times a reference to it was refused because it would lead to a loop
+    # cumulativeTime: seconds spent evaluating it, including the nodes it referenced (counted once when it recurses)
+    # selfTime: seconds spent evaluating it, not counting the nodes it referenced
+    # lookups, lookupTime: path lookups made by its expression, and seconds they took
+    # operators: operator -> times its expression applied it
+# operators maps operator -> {'count', 'time'}, over every node
+# Times are taken with clock (a function returning seconds), time.perf_counter by default
+class Profiler:
     
-    outDict['system'] = system
-    return outDict   
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.nodes = {}
+        self.operators = {}
+        
+        # Chains of nodes, with lookups and operators as extra frames, are kept as a tree of frames so a chain costs
+        # the same to record however deep it is: frames[id] is (id of the frame it's called from or None, name),
+        # frameIds maps (caller id, name) -> id, and stacks maps id -> seconds of self time in that chain
+        self.frames = []
+        self.frameIds = {}
+        self.stacks = {}
+        
+        # Nodes being evaluated, innermost last, as [path, start time, time in nodes it referenced, time in lookups and
+        # operators, frame id]
+        self.active = []
+        self.depths = {}
+    
+    # Statistics for path, made when first needed
+    def node(self, path):
+        stats = self.nodes.get(path)
+        if stats == None:
+            stats = {'count' : 0, 'hits' : 0, 'misses' : 0, 'loops' : 0, 'cumulativeTime' : 0.0, 'selfTime' : 0.0,
+                     'lookups' : 0, 'lookupTime' : 0.0, 'operators' : {}}
+            self.nodes[path] = stats
+        return stats
+    
+    # The id of the frame called name under the frame with id caller (None for the top), made when first needed
+    def frameId(self, caller, name):
+        key = (caller, name)
+        frame = self.frameIds.get(key)
+        if frame == None:
+            frame = len(self.frames)
+            self.frames.append(key)
+            self.frameIds[key] = frame
+        return frame
+    
+    # The chain of frames ending with the frame with this id, as a folded stack key
+    def stackKey(self, frame):
+        names = []
+        while not frame == None:
+            frame, name = self.frames[frame]
+            names.append(name)
+        names.reverse()
+        return ';'.join(names)
+    
+    # Evaluation of path starts (reference says whether it was reached through a reference, rather than asked for)
+    def enter(self, path, reference=False):
+        stats = self.node(path)
+        stats['count'] += 1
+        if reference: stats['misses'] += 1
+        self.depths[path] = self.depths.get(path, 0) + 1
+        caller = self.active[len(self.active)-1][4] if len(self.active) > 0 else None
+        self.active.append([path, self.clock(), 0.0, 0.0, self.frameId(caller, path)])
+    
+    # Evaluation of the innermost node started finishes
+    def exit(self):
+        path, start, inner, extra, frame = self.active.pop()
+        elapsed = self.clock() - start
+        stats = self.nodes[path]
+        
+        # Count recursive evaluations of a node once in its cumulative time
+        self.depths[path] -= 1
+        if self.depths[path] == 0:
+            del self.depths[path]
+            stats['cumulativeTime'] += elapsed
+        stats['selfTime'] += elapsed - inner
+        
+        self.stacks[frame] = self.stacks.get(frame, 0.0) + elapsed - inner - extra
+        if len(self.active) > 0: self.active[len(self.active)-1][2] += elapsed
+    
+    # A reference to path found its result memoized
+    def hit(self, path):
+        self.node(path)['hits'] += 1
+    
+    # A reference to path was refused to prevent a loop
+    def loop(self, path):
+        self.node(path)['loops'] += 1
+    
+    # The innermost node spent seconds looking up a path
+    def lookup(self, seconds):
+        if len(self.active) == 0: return
+        frame = self.active[len(self.active)-1]
+        stats = self.nodes[frame[0]]
+        stats['lookups'] += 1
+        stats['lookupTime'] += seconds
+        self.addFrame(frame, '(lookup)', seconds)
+    
+    # The innermost node spent seconds applying operator
+    def operator(self, operator, seconds):
+        totals = self.operators.setdefault(operator, {'count' : 0, 'time' : 0.0})
+        totals['count'] += 1
+        totals['time'] += seconds
+        if len(self.active) == 0: return
+        frame = self.active[len(self.active)-1]
+        operators = self.nodes[frame[0]]['operators']
+        operators[operator] = operators.get(operator, 0) + 1
+        self.addFrame(frame, '(' + operator + ')', seconds)
+    
+    # Record seconds spent in a leaf frame (a lookup or operator) under the innermost node
+    def addFrame(self, frame, name, seconds):
+        frame[3] += seconds
+        leaf = self.frameId(frame[4], name)
+        self.stacks[leaf] = self.stacks.get(leaf, 0.0) + seconds
+    
+    # The profile in the folded format flame graph tools read: one 'node;node;...;frame count' line per stack
+    # Counts are whole units of 1/scale seconds (microseconds by default); stacks rounding to 0 are left out
+    def folded(self, scale=1000000):
+        lines = []
+        for frame in self.stacks:
+            count = int(round(self.stacks[frame] * scale))
+            if count > 0: lines.append(self.stackKey(frame).replace(' ', '_') + ' ' + str(count))
+        return '\n'.join(lines)
+    
+    # Statistics collected so far, as a dict of 'nodes' and 'operators'
+    def report(self):
+        return {'nodes' : self.nodes, 'operators' : self.operators}
 
-def operate(opDict, operatorSymbol, numArgs, variableEvaluable, variableValues):
+# Applies the operator operatorSymbol, found in opDict (eg binaryOpsNumsDict), taking numArgs arguments
+# Kept for callers from before operatorRegistry; evaluation uses operateEntry. A registered operator is applied
+# through its registry entry (so with its kernels); a function opDict has for it otherwise is applied without any
+def operate(opDict, operatorSymbol, numArgs, variableEvaluable, variableValues, context=None, path=None):
+    func = opDict[operatorSymbol]
+    entry = operatorRegistry.get(operatorSymbol)
+    if entry == None or not entry['func'] is func or not entry['arity'] == numArgs:
+        entry = {'symbol' : operatorSymbol, 'func' : func, 'arity' : numArgs, 'typing' : 'numbers' if numArgs == 2 else 'sets',
+                 'vectorized' : None, 'folded' : None}
+    return operateEntry(entry, variableEvaluable, variableValues, context, path)
+
+def operateEntry(entry, variableEvaluable, variableValues, context=None, path=None):
     
+    # entry is the operator's entry in operatorRegistry (a number operator, or a unary set operator)
     # Assumes all variables are required to evaluate
     # Operates on the first two, then if there are more operates on the remaining one at a time
+    # Problems are reported through context (logged if there isn't one), as found at node path
     
     # Initialize the output
     outDict = {'value':None, 'wellDefined':False}
     
     # Determine what the operation is
-    func = opDict[operatorSymbol]
+    operatorSymbol = entry['symbol']
+    func = entry['func']
+    numArgs = entry['arity']
     
     # If there aren't at least as many values as arguments, don't do anything
     if len(variableValues) < numArgs: 
-        print('> ERROR: not enough values in ' + str(variableValues) + ' to perform ' + operatorSymbol + ' (need at least ' + numArgs + ' )')
+        if context == None: context = EvalContext()
+        context.diagnose('not-enough-values', path, 'not enough values in %s to perform %s (need at least %s)', variableValues, operatorSymbol, numArgs)
         return outDict
+    
+    # Arrays only come from vectorized evaluation; operate on them with NumPy, using the operator's kernel if it
+    # has one (binary operators without one are given lists, unary ones are given the array)
+    if not numpy == None and not False in variableEvaluable:
+        for elem in variableValues:
+            if type(elem) is numpy.ndarray:
+                kernel = entry['vectorized']
+                if not kernel == None and numArgs == 1: return {'value' : kernel(variableValues[0]), 'wellDefined' : True}
+                if not kernel == None: return operateVectorized(func, entry, variableValues)
+                if numArgs == 2: variableValues = [asList(value) for value in variableValues]
+                break
+    
+    # Lazy lists give lazy lists, following the same rules as lists (see below)
+    if numArgs == 2 and not False in variableEvaluable:
+        for elem in variableValues:
+            if type(elem) is LazyList: return {'value' : operateLazy(func, variableValues), 'wellDefined' : True}
             
     try:
         if not False in variableEvaluable:
@@ -386,23 +1032,23 @@ def operate(opDict, operatorSymbol, numArgs, variableEvaluable, variableValues):
                 for elem in variableValues[1:len(variableValues)]:
                     
                     # Case where toOutput and elem are both numbers: operate
-                    if not type(outputValue) is list and not type(elem) is list:
+                    if not isList(outputValue) and not isList(elem):
                         outputValue = func(outputValue, elem)
                     
                     # Case where toOutput is num, elem is list: distribute
-                    elif not type(outputValue) is list and type(elem) is list:
+                    elif not isList(outputValue) and isList(elem):
                         for subElem in elem:
                             outputValue = func(outputValue, subElem)
                     
                     # Case where toOutput is list, elem is num: distribute
-                    elif type(outputValue) is list and not type(elem) is list:
+                    elif isList(outputValue) and not isList(elem):
                         newOutput = []
                         for subVal in outputValue:
                             newOutput.append(func(subVal, elem))
                         outputValue = newOutput
                     
                     # Case where both are lists: operate on pairs (like dot notation)
-                    elif type(outputValue) is list and type(elem) is list:
+                    elif isList(outputValue) and isList(elem):
                         newOutput = []
                         for i, subVal in enumerate(outputValue):
                             newOutput.append(func(subVal, elem[i]))
@@ -418,6 +1064,87 @@ def operate(opDict, operatorSymbol, numArgs, variableEvaluable, variableValues):
     
     return outDict
 
+# Same as operate for a binary operator, when one or more values are LazyLists
+# Lists that come out are LazyLists, which apply func to each element as it's read
+def operateLazy(func, variableValues):
+    
+    # Initialize, may be list or not
+    outputValue = variableValues[0]
+    
+    # Operate using every successive element of variableValues
+    for elem in variableValues[1:len(variableValues)]:
+        outputIsList = isList(outputValue) or type(outputValue) is LazyList
+        elemIsList = isList(elem) or type(elem) is LazyList
+        
+        # Case where toOutput and elem are both numbers: operate
+        if not outputIsList and not elemIsList: outputValue = func(outputValue, elem)
+        
+        # Case where toOutput is num, elem is list: distribute (which reduces the list, so do it now)
+        elif not outputIsList:
+            for subElem in elem: outputValue = func(outputValue, subElem)
+        
+        # Case where toOutput is list, elem is num: distribute
+        elif not elemIsList: outputValue = LazyList(distributeLazily(func, outputValue, elem))
+        
+        # Case where both are lists: operate on pairs (like dot notation)
+        else: outputValue = LazyList(pairLazily(func, outputValue, elem))
+    
+    return outputValue
+
+# A function giving func(subVal, elem) for each subVal in values, one at a time
+def distributeLazily(func, values, elem):
+    def generate():
+        for subVal in values: yield func(subVal, elem)
+    return generate
+
+# A function giving func(A[i], B[i]) for each element of A, one at a time; B must be at least as long as A
+def pairLazily(func, A, B):
+    def generate():
+        others = iter(B)
+        for subVal in A:
+            for other in others: break
+            else: raise IndexError('list index out of range')
+            yield func(subVal, other)
+    return generate
+
+# Same as operate for a binary operator (with the registry entry given), when one or more values are NumPy arrays
+# Follows the same rules as lists: numbers are distributed over arrays, and arrays are matched pairwise
+def operateVectorized(func, entry, variableValues):
+    
+    elementwise = entry['vectorized']
+    
+    # Initialize, may be array or not
+    outputValue = variableValues[0]
+    if isList(outputValue): outputValue = numpy.asarray(outputValue, dtype=float)
+    
+    # Operate using every successive element of variableValues
+    # Dividing by zero raises, as it does for numbers, rather than giving inf or nan
+    for elem in variableValues[1:len(variableValues)]:
+        if isList(elem): elem = numpy.asarray(elem, dtype=float)
+        
+        # Case where toOutput and elem are both numbers: operate
+        if not type(outputValue) is numpy.ndarray and not type(elem) is numpy.ndarray:
+            outputValue = func(outputValue, elem)
+        
+        # Case where toOutput is num, elem is array: operate with each element in turn
+        elif not type(outputValue) is numpy.ndarray:
+            if not entry['folded'] == None: outputValue = entry['folded'](float(outputValue), elem)
+            else:
+                for subElem in elem.tolist(): outputValue = func(outputValue, subElem)
+        
+        # Case where toOutput is array, elem is num: distribute
+        elif not type(elem) is numpy.ndarray:
+            with numpy.errstate(divide='raise', invalid='raise'):
+                outputValue = elementwise(outputValue, float(elem))
+        
+        # Case where both are arrays: operate on pairs (like dot notation), using as much of elem as toOutput needs
+        else:
+            if len(elem) < len(outputValue): raise IndexError('list index out of range')
+            with numpy.errstate(divide='raise', invalid='raise'):
+                outputValue = elementwise(outputValue, elem[0:len(outputValue)])
+    
+    return {'value':outputValue, 'wellDefined':True}
+
 # Binary ops on numbers
 def plus (A, B): return float(A) + float(B)
 def minus (A, B): return float(A) - float(B)
@@ -432,41 +1159,162 @@ def greaterThanOrEqual(A, B): return float(A) >= float(B)
 
 # Binary ops on sets
 def union(A,B):
-    toReturn = []
-    inputs = [A,B]
+    toReturn = OrderedSet()
+    inputs = [asList(A),asList(B)]
     for elem in inputs:
         if type(elem) is list: 
-            toReturn = removeRedundantValues(toReturn + elem)
+            toReturn.update(elem)
         else: 
-            if not elem == None and not elem in toReturn: 
-                toReturn.append(elem)
-    return toReturn
+            if not elem == None: 
+                toReturn.add(elem)
+    return list(toReturn)
 def intersection(A,B):
     toReturn = []
-    for elem in A:
+    B = OrderedSet(asList(B))
+    for elem in asList(A):
         if elem in B: toReturn.append(elem)
     return toReturn
 def dot(A,B):
+    if isArray(A) or isArray(B):
+        if len(B) < len(A): raise IndexError('list index out of range')
+        return float(numpy.dot(numpy.asarray(A, dtype=float), numpy.asarray(B[0:len(A)], dtype=float)))
     toReturn = 0;
+    
+    # Stream through lazy lists in step rather than indexing them
+    if type(A) is LazyList or type(B) is LazyList:
+        others = iter(B)
+        for elem in A:
+            for other in others: break
+            else: raise IndexError('list index out of range')
+            toReturn += float(elem)*float(other)
+        return toReturn
+    
     for i, elem in enumerate(A): toReturn += float(elem)*float(B[i])
     return toReturn
 
 # Unary ops on sets
 def sumfn(A):
-    toReturn = 0
-    for elem in A: toReturn += float(elem)
-    return toReturn
+    if isArray(A): return float(A.sum())
+    
+    # Adds in the same order as a loop would, one scan in C (eg over a column of a ColumnarCollection)
+    return sum(map(float, A))
 def pifn(A):
-    toReturn = 0
-    for elem in A: toReturn = toReturn*elem
+    if isArray(A): return float(A.prod())
+    toReturn = 1
+    for elem in A: toReturn = toReturn*float(elem)
     return toReturn
 def cardinality(A):
     return len(A)
+
+# Whether value is a NumPy array (always False without NumPy)
+def isArray(value):
+    return not numpy == None and type(value) is numpy.ndarray
+
+# Arrays (NumPy or typed) as lists of floats and LazyLists as lists, so set operators treat them like lists
+# Anything else is returned as it is
+def asList(value):
+    if type(value) is LazyList: return value.materialize()
+    return value.tolist() if isArray(value) or type(value) is array.array else value
+
+# Whether value is a node that has nodes inside it: a dict, or another mapping (eg a ColumnarCollection or one of its rows)
+def isNode(value):
+    return type(value) == dict or isinstance(value, Mapping)
+
+# Whether value is a list as operators see it: a list, or a typed array of numbers (see normalizeSystem)
+def isList(value):
+    return type(value) is list or type(value) is array.array
+
+# Every operator we know how to deal with: symbol -> dict of
+    # symbol: the symbol again, so the entry is all operateEntry needs
+    # func: the function applying it (None for '=', which evaluate handles itself)
+    # arity: 1 (func(A), applied to the one argument) or 2 (func(A, B), applied left to right over the arguments)
+    # typing: 'numbers' (numbers are distributed over lists, and lists are matched pairwise) or 'sets' (func
+    #         gets whole lists), or 'assignment' for '='
+    # vectorized: optional NumPy kernel used when an argument is an array: element-wise for number operators,
+    #             and on the whole array for unary set operators
+    # folded: optional kernel for a number operator applied to a number then each element of an array in turn,
+    #         in one step: folded(number, array)
+# Filled in by registerOperator, which keeps operators (the symbols) in step with it
+operatorRegistry = {}
+operators = []
+
+# The functions of the registered operators of one kind, by symbol, read from operatorRegistry as it is now
+class OperatorTable(Mapping):
+    
+    def __init__(self, typing, arity):
+        self.typing = typing
+        self.arity = arity
+    
+    def __getitem__(self, symbol):
+        entry = operatorRegistry.get(symbol)
+        if entry == None or not (entry['typing'] == self.typing and entry['arity'] == self.arity): raise KeyError(symbol)
+        return entry['func']
+    
+    def __iter__(self):
+        for symbol in list(operatorRegistry):
+            if symbol in self: yield symbol
+    
+    def __len__(self):
+        return sum(1 for symbol in self)
+
+binaryOpsNumsDict = OperatorTable('numbers', 2)
+binaryOpsSetsDict = OperatorTable('sets', 2)
+unaryOpsSetsDict = OperatorTable('sets', 1)
+
+# Add an operator (or replace the one with this symbol) for formulas to use; see operatorRegistry
+# Symbols can't have spaces or dots in them, and '=' can't be replaced
+# Compiled formulas are forgotten, since text that now reads as (or no longer reads as) this operator compiles
+# differently. Results kept in a ResultCache aren't, so use a new cache after changing what an operator does
+def registerOperator(symbol, func, arity, typing='numbers', vectorized=None, folded=None):
+    
+    if symbol == '' or ' ' in symbol or '.' in symbol or symbol in ('this', 'parent'):
+        raise ValueError('operator symbol ' + repr(symbol) + ' is not allowed')
+    if symbol == '=' and symbol in operatorRegistry: raise ValueError('the = operator can\'t be replaced')
+    if not (typing, arity) in (('numbers', 2), ('sets', 1), ('sets', 2), ('assignment', 2)):
+        raise ValueError(typing + ' operators with ' + str(arity) + ' argument(s) are not supported')
+    
+    operatorRegistry[symbol] = {'symbol' : symbol, 'func' : func, 'arity' : arity, 'typing' : typing,
+                                'vectorized' : vectorized, 'folded' : folded}
+    if not symbol in operators: operators.append(symbol)
+    with compileLock: compileCache.clear()
+
+# The NumPy function called name, or None without NumPy
+def numpyKernel(name):
+    return None if numpy == None else getattr(numpy, name)
+
+# Binary ops on numbers, with their element-wise NumPy versions and (for number op array) kernels that operate
+# on the number with each element in turn in one step
+registerOperator('+', plus, 2, 'numbers', numpyKernel('add'), lambda A, B: A + float(B.sum()))
+registerOperator('-', minus, 2, 'numbers', numpyKernel('subtract'), lambda A, B: A - float(B.sum()))
+registerOperator('*', multiply, 2, 'numbers', numpyKernel('multiply'), lambda A, B: A * float(B.prod()))
+registerOperator('/', divide, 2, 'numbers', numpyKernel('divide'), lambda A, B: A / float(B.prod()))
+registerOperator('%', modulus, 2, 'numbers', numpyKernel('remainder'))
+registerOperator('==', isEqual, 2, 'numbers', numpyKernel('equal'))
+registerOperator('<', lessThan, 2, 'numbers', numpyKernel('less'))
+registerOperator('<=', lessThanOrEqual, 2, 'numbers', numpyKernel('less_equal'))
+registerOperator('>', greaterThan, 2, 'numbers', numpyKernel('greater'))
+registerOperator('>=', greaterThanOrEqual, 2, 'numbers', numpyKernel('greater_equal'))
+registerOperator('=', None, 2, 'assignment')
+
+# Binary and unary ops on sets
+registerOperator('union', union, 2, 'sets')
+registerOperator('intersection', intersection, 2, 'sets')
+registerOperator('sum', sumfn, 1, 'sets')
+registerOperator('sigma', sumfn, 1, 'sets')
+registerOperator('pi', pifn, 1, 'sets')
+registerOperator('dot', dot, 2, 'sets')
+registerOperator('cardinality', cardinality, 1, 'sets')
     
 # Follows an input path through a system
 # Returns the shortest version of this path plus whatever (value or node) we find there
 # Node must be a node of the top-level system, otherwise it can't find it
-def followPath(system, inputPath):
+def followPath(system, inputPath, index=None):
+    
+    # If we have a PathIndex for this system, let it resolve the path
+    if not index == None:
+        handle = index.resolve(inputPath)
+        if handle == None: return {'value' : None, 'path' : None}
+        return {'value' : handle['value'], 'path' : handle['path']}
     
     # Initialize dict with return params
     toReturn = {'value' : None, 'path' : None}
@@ -493,7 +1341,7 @@ def followPath(system, inputPath):
 
         # If the next entry is a key in this node, shift focus to that
         inputPathSplitInNode = False
-        if type(currentNode) == dict:
+        if type(currentNode) == dict or isinstance(currentNode, Mapping):
             if inputPathSplit[0] in currentNode: 
                 inputPathSplitInNode = True
                 nodeName = inputPathSplit.pop(0)
@@ -539,18 +1387,145 @@ def followPath(system, inputPath):
     
     return toReturn
     
+# Precomputed handles for paths through a system, so paths can be resolved without re-walking from the top
+# Each handle is a dict with the shortest top-referenced 'path', the 'value' there, the handle of its 'parent'
+# node, its 'key' in the parent, and 'children' handles by key. The top of the system has path ''
+# Writes must go through setValue(system, path, value, index) to keep the index in sync with the system
+class PathIndex:
+    
+    def __init__(self, system, precompute=False):
+        self.system = system
+        self.root = {'path' : '', 'value' : system, 'parent' : None, 'key' : None, 'children' : {}}
+        self.root['parent'] = self.root
+        
+        # Shortest top-referenced path -> handle, for every handle made so far
+        self.handles = {'' : self.root}
+        
+        # Handles are otherwise made the first time a path reaches them
+        if precompute: self.indexAll(self.root)
+    
+    # Make handles for every node below handle
+    def indexAll(self, handle):
+        if isNode(handle['value']):
+            for key in handle['value']: self.indexAll(self.child(handle, key))
+    
+    # Handle for key inside the node at handle (which must be a dict, or other mapping, containing key)
+    def child(self, handle, key):
+        childHandle = handle['children'].get(key)
+        if childHandle == None:
+            path = key if handle['path'] == '' and handle is self.root else handle['path'] + '.' + key
+            childHandle = {'path' : path, 'value' : handle['value'][key], 'parent' : handle, 'key' : key, 'children' : {}}
+            handle['children'][key] = childHandle
+            self.handles[path] = childHandle
+        return childHandle
+    
+    # Same as followPath, but returns the handle (or None if the path isn't valid)
+    def resolve(self, inputPath):
+        
+        # Paths that are already the shortest path are a single lookup
+        handle = self.handles.get(inputPath)
+        if not handle == None and not handle is self.root: return handle
+        
+        # First node entry must be a top-level node in the system
+        pathSplit = inputPath.split('.')
+        if not pathSplit[0] in self.system: return None
+        return self.walk(self.child(self.root, pathSplit[0]), pathSplit, 1)
+    
+    # Resolve a path relative to the node at the (shortest, top-referenced) path node
+    def resolveFrom(self, node, relativePath):
+        handle = self.handles.get(node)
+        if handle == None: return self.resolve(node + '.' + relativePath)
+        return self.walk(handle, relativePath.split('.'), 0)
+    
+    # Follow pathSplit[start:] from handle: keys go down, 'this' stays, 'parent' goes up one level
+    def walk(self, handle, pathSplit, start):
+        for i in range(start, len(pathSplit)):
+            key = pathSplit[i]
+            value = handle['value']
+            if (type(value) == dict or isinstance(value, Mapping)) and key in value: handle = self.child(handle, key)
+            elif key == 'this': pass
+            elif key == 'parent': handle = handle['parent']
+            else: return None
+        return handle
+    
+    # Copy the dicts from the top of the system down to handle, so the one at handle can be changed without
+    # changing the system we've indexed. The index moves to the new system, which is returned
+    def copyPath(self, handle):
+        handles = []
+        while not handle is self.root:
+            handles.append(handle)
+            handle = handle['parent']
+        self.root['value'] = dict(self.root['value'])
+        self.system = self.root['value']
+        for handle in reversed(handles):
+            
+            # A row is a view of its collection, which has just been copied
+            if type(handle['value']) is ColumnarRow: handle['value'] = handle['parent']['value'][handle['key']]
+            else:
+                handle['value'] = copyNode(handle['value'])
+                handle['parent']['value'][handle['key']] = handle['value']
+            
+            # Rows and columns we've made handles for are in the copy now
+            if type(handle['value']) is ColumnarCollection:
+                for key in handle['children']: handle['children'][key]['value'] = handle['value'][key]
+        return self.system
+    
+    # Keep the index in sync after the node at handle was set to value
+    def update(self, handle, value):
+        
+        # Forget everything below it, since it may not be there anymore
+        toForget = list(handle['children'].values())
+        while len(toForget) > 0:
+            forgotten = toForget.pop()
+            if self.handles.get(forgotten['path']) is forgotten: del self.handles[forgotten['path']]
+            toForget.extend(forgotten['children'].values())
+        handle['children'] = {}
+        handle['value'] = value
+        self.updateColumns(handle)
+    
+    # Cells of a ColumnarCollection share their values with its columns, so after setting one, update the
+    # handles we've made for the other
+    def updateColumns(self, handle):
+        parent = handle['parent']
+        if type(parent['value']) is ColumnarRow: collection, fields = parent['parent'], [handle['key']]
+        elif type(parent['value']) is ColumnarCollection and handle['key'] in parent['value'].rows:
+            collection, fields = parent, list(parent['value'].columns)
+        elif type(parent['value']) is ColumnarCollection:
+            for rowHandle in parent['children'].values():
+                cell = rowHandle['children'].get(handle['key'])
+                if type(rowHandle['value']) is ColumnarRow and not cell == None: cell['value'] = rowHandle['value'][handle['key']]
+            return
+        else: return
+        for field in fields:
+            column = collection['children'].get(field)
+            if not column == None: column['value'] = collection['value'].columns[field]
+
 # Sets value of path through nodes
 # Path must be top-referenced but does not need to be the shortest path    
-def setValue(system, path, value):
+# If a PathIndex for this system is given, it's used to find the path and kept in sync
+# If copyOnWrite, system isn't changed: the dicts on the path are copied and the new system is returned,
+# sharing every other node with the old one (the index, if given, moves to the new system)
+def setValue(system, path, value, index=None, copyOnWrite=False):
+    
+    # Set through the index if we can
+    if not index == None:
+        handle = index.resolve(path)
+        if not handle == None and not handle is index.root:
+            if copyOnWrite: system = index.copyPath(handle['parent'])
+            handle['parent']['value'][handle['key']] = value
+            index.update(handle, handle['parent']['value'][handle['key']])
+            return system
     
     # Find the path
     pathAnalysis = followPath(system, path)
     shortestPath = pathAnalysis['path']
     splitPath = shortestPath.split('.')
+    if copyOnWrite: system = dict(system)
     currentNode = system
     
-    # Follow the path
+    # Follow the path (copying as we go if copyOnWrite)
     for elem in splitPath[0:len(splitPath)-1] : 
+        if copyOnWrite and not type(currentNode[elem]) is ColumnarRow: currentNode[elem] = copyNode(currentNode[elem])
         currentNode = currentNode[elem]
         
     # Set the element and return system
@@ -558,6 +1533,1156 @@ def setValue(system, path, value):
     return system
 
 
+# Paths of the ColumnarCollection columns that setting the node at path changes (besides the node itself)
+def columnsChanged(paths, path):
+    handle = paths.resolve(path)
+    if handle == None or handle is paths.root: return []
+    parent = handle['parent']
+    if type(parent['value']) is ColumnarRow: return [parent['parent']['path'] + '.' + handle['key']]
+    if type(parent['value']) is ColumnarCollection and handle['key'] in parent['value'].rows:
+        return [parent['path'] + '.' + field for field in parent['value'].columns]
+    return []
+
+# A copy of a dict or ColumnarCollection that can be changed without changing node
+def copyNode(node):
+    if type(node) is ColumnarCollection: return node.copy()
+    return dict(node)
+
+# Lists the top-referenced path of every leaf (non-dict value) in a system, depth first
+# Leaves of a ColumnarCollection are its cells (collection.key.field)
+def listNodes(system, prefix=''):
+    nodes = []
+    for key in system:
+        if isNode(system[key]): nodes.extend(listNodes(system[key], prefix + key + '.'))
+        else: nodes.append(prefix + key)
+    return nodes
+
+# Replaces literal node values in system (in place) with what evaluating them gives, so evaluation can return
+# them as they are instead of reading them again:
+    # strings that are numbers or bools become floats and bools
+    # lists of numbers, and strings that are lists of number literals, become typed arrays (see typedList)
+# Formulas and anything else are left as they are. Returns system
+def normalizeSystem(system):
+    for key in system:
+        value = system[key]
+        if type(value) == dict: normalizeSystem(value)
+        else: system[key] = typedValue(value)
+    return system
+
+# The typed form of one node value for normalizeSystem (value itself if it has none)
+def typedValue(value):
+    
+    if type(value) == str and not value == '':
+        compiled = compileExpression(value)
+        if compiled['kind'] == 'value' and (type(compiled['value']) is float or type(compiled['value']) is bool):
+            return compiled['value']
+        if compiled['kind'] == 'list':
+            for elem in compiled['elements']:
+                if not elem['kind'] == 'value' or not type(elem['value']) is float: return value
+            typed = typedList([elem['value'] for elem in compiled['elements']])
+            return value if typed == None else typed
+        return value
+    
+    if type(value) is list:
+        typed = typedList(value)
+        if not typed == None: return typed
+    return value
+
+# values as an array of 64 bit ints ('q') if they're all ints that fit, of doubles ('d') if they're all numbers,
+# otherwise (or if there are none) None
+def typedList(values):
+    if len(values) == 0: return None
+    integers = True
+    for elem in values:
+        if type(elem) is int: integers = integers and -2**63 <= elem < 2**63
+        elif type(elem) is float: integers = False
+        else: return None
+    return array.array('q' if integers else 'd', values)
+
+# Looks over every formula in system for work evaluation can skip, and returns a dict of:
+    # shared: texts of subexpressions that appear more than once reading the same paths (in one formula or
+    #         across formulas), to give EvalContext(shared=...) so each is evaluated once per pass
+    # folded: texts of subexpressions of only literals, which are evaluated once when compiled (see foldConstant)
+# Subexpressions that set anything with '=' are never shared
+def optimizeSystem(system):
+    
+    context = EvalContext()
+    counts = {}
+    folded = OrderedSet()
+    for node in listNodes(system):
+        value = context.pathIndex(system).resolve(node)['value']
+        if not type(value) == str or value == '': continue
+        
+        toVisit = [compileExpression(value)]
+        while len(toVisit) > 0:
+            compiled = toVisit.pop()
+            kind = compiled['kind']
+            if kind == 'constant': folded.add(compiled['text'])
+            elif kind == 'symbol': toVisit.append(compiled['fallback'])
+            elif kind == 'list': toVisit.extend(compiled['elements'])
+            elif kind == 'prefix':
+                if not setsAnything(compiled):
+                    key = context.sharedKey(system, node, compiled)
+                    counts[key] = counts.get(key, 0) + 1
+                toVisit.extend(compiled['args'])
+    
+    shared = set([key[0] for key in counts if counts[key] > 1])
+    return {'shared' : shared, 'folded' : list(folded)}
+
+# Whether a compiled expression has an '=' operation in it
+def setsAnything(compiled):
+    toVisit = [compiled]
+    while len(toVisit) > 0:
+        compiled = toVisit.pop()
+        if compiled['kind'] == 'prefix':
+            if compiled['operator'] == '=': return True
+            toVisit.extend(compiled['args'])
+        elif compiled['kind'] == 'symbol': toVisit.append(compiled['fallback'])
+        elif compiled['kind'] == 'list': toVisit.extend(compiled['elements'])
+    return False
+
+# Builds a persistent dependency index by evaluating nodes (default: every leaf) and keeping what parse reports
+# context is the EvalContext to evaluate them with (a new one if not given); its memo becomes the index's memo, and
+# problems found are reported through it (so with diagnostics='collect' they're in context.records)
+# The index is a dict:
+    # system: the system after evaluation (it may be changed by '=' operations)
+    # references: node path -> paths it referenced when last evaluated
+    # outputs: node path -> paths it set with '=' when last evaluated
+    # writers: path -> node paths that set it with '='
+    # dependents: path -> node paths to re-evaluate when it changes (readers, plus '=' targets of a node)
+    # results: node path -> {'value', 'wellDefined'} from the last evaluation
+    # memo: the EvalContext memo shared by every pass over the index: results other nodes can reuse when they
+    #       read a node (only those whose evaluation didn't set anything or run into a loop; see EvalContext.remember)
+def buildDependencyIndex(system, nodes=None, context=None):
+    
+    # One pass, so each node is evaluated once however many nodes read it
+    if context == None: context = EvalContext()
+    index = {'system' : system, 'references' : {}, 'outputs' : {}, 'writers' : {}, 'dependents' : {}, 'results' : {},
+             'memo' : context.memo}
+    if nodes == None: nodes = listNodes(system)
+    
+    for node in nodes:
+        node = followPath(index['system'], node, context.pathIndex(index['system']))['path']
+        if node == None or node in index['references']: continue
+        
+        # Evaluate, reusing results of nodes we've already evaluated, and record what this node touches
+        loopsBefore = context.loops
+        writesBefore = context.writes
+        result = parse(index['system'], node, None, [], [], context)
+        index['system'] = result['system']
+        indexNode(index, node, result, context.loops == loopsBefore and context.writes == writesBefore)
+        
+    return index
+
+# Records (or replaces) the edges and stored result of one evaluated node in a dependency index
+# The result is only memoized if cacheable (its evaluation didn't set anything or run into a loop)
+def indexNode(index, node, result, cacheable=True):
+    
+    dependents = index['dependents']
+    writers = index['writers']
+    
+    # Drop the edges this node had the last time it was evaluated
+    for path in index['references'].get(node, []): dependents[path].discard(node)
+    for path in index['outputs'].get(node, []):
+        writers[path].discard(node)
+        dependents[node].discard(path)
+    
+    # A node is a dependent of what it references, and an '=' target is a dependent of the node that sets it
+    index['references'][node] = result['referenced']
+    index['outputs'][node] = result['output']
+    for path in result['referenced']: dependents.setdefault(path, OrderedSet()).add(node)
+    for path in result['output']:
+        writers.setdefault(path, OrderedSet()).add(node)
+        dependents.setdefault(node, OrderedSet()).add(path)
+    
+    index['results'][node] = {'value' : result['value'], 'wellDefined' : result['wellDefined']}
+    if cacheable: index['memo'][node] = index['results'][node]
+    else: index['memo'].pop(node, None)
+
+# Re-evaluates only the nodes affected by a change to changedPaths, in topological order
+# Nodes that aren't affected keep their stored results, so the cost follows the size of the affected subgraph
+# context is the EvalContext to evaluate them with (one made on the index's memo, if not given)
+# Returns a dict with the updated system, the new values of affected nodes, and the order they were evaluated in
+def recompute(index, changedPaths, context=None):
+    
+    system = index['system']
+    dependents = index['dependents']
+    
+    # Walk dependents out from the changed paths. A change to a node also changes the dicts that contain it,
+    # (if it's a dict) the nodes it contains, and (if it's in a ColumnarCollection) the columns it's in
+    paths = PathIndex(system)
+    affected = []
+    toVisit = []
+    for path in changedPaths:
+        pathResult = followPath(system, path, paths)
+        if pathResult['path'] == None: continue
+        toVisit.append(pathResult['path'])
+        if isNode(pathResult['value']): toVisit = toVisit + listNodes(pathResult['value'], pathResult['path'] + '.')
+    
+    # A column comes after the nodes in it that change (columnsOf)
+    columnsOf = {}
+    seen = set(toVisit)
+    while len(toVisit) > 0:
+        path = toVisit.pop()
+        if path in index['references']: affected.append(path)
+        columnsOf[path] = columnsChanged(paths, path)
+        for column in columnsOf[path]:
+            if not column in seen:
+                seen.add(column)
+                toVisit.append(column)
+        
+        # Readers of this path and of every dict above it
+        pathSplit = path.split('.')
+        for i in range(len(pathSplit), 0, -1):
+            for dependent in dependents.get('.'.join(pathSplit[0:i]), []):
+                if not dependent in seen:
+                    seen.add(dependent)
+                    toVisit.append(dependent)
+    
+    # Order the affected nodes so each comes after the affected nodes it depends on (Kahn's algorithm)
+    affectedSet = set(affected)
+    waitingOn = {}
+    for node in affected:
+        waitingOn[node] = len([path for path in index['references'][node] + list(index['writers'].get(node, [])) if path in affectedSet and not path == node])
+    for path in affected:
+        for column in columnsOf[path]:
+            if column in affectedSet: waitingOn[column] += 1
+    ready = [node for node in affected if waitingOn[node] == 0]
+    order = []
+    while len(ready) > 0:
+        node = ready.pop()
+        order.append(node)
+        for dependent in list(dependents.get(node, [])) + columnsOf[node]:
+            if dependent in waitingOn and waitingOn[dependent] > 0:
+                waitingOn[dependent] -= 1
+                if waitingOn[dependent] == 0: ready.append(dependent)
+    
+    # Nodes on a cycle never become ready; evaluate them last and let parse report the loop
+    order = order + [node for node in affected if not node in order]
+    
+    # Forget stale results, then evaluate in order so every memoized result we reuse is up to date
+    # Besides affected nodes, that's anything else that changed and was memoized when it was read (eg a dict read
+    # as a whole), and the dicts containing it
+    for path in seen:
+        pathSplit = path.split('.')
+        for i in range(len(pathSplit), 0, -1): index['memo'].pop('.'.join(pathSplit[0:i]), None)
+    if context == None: context = EvalContext(index['memo'])
+    values = {}
+    for node in order:
+        loopsBefore = context.loops
+        writesBefore = context.writes
+        result = parse(system, node, None, [], [], context)
+        system = result['system']
+        indexNode(index, node, result, context.loops == loopsBefore and context.writes == writesBefore)
+        values[node] = result['value']
+    
+    index['system'] = system
+    return {'system' : system, 'values' : values, 'order' : order}
+
+# Evaluates many nodes under many input scenarios in one call
+# Each scenario is a dict of top-referenced path -> value, set before its nodes are evaluated
+# Compiled formulas, path resolution and results that don't depend on a scenario's inputs are shared
+# across the whole batch. The system is changed while evaluating but is restored before returning
+# (unless the context is copyOnWrite, in which case it's never changed)
+# Returns a list with a dict per scenario:
+    # results: node -> the dict parse returns for it (without 'system')
+    # written: path -> value for everything set by '=' operations in that scenario
+    # system: the system as that scenario left it (only if the context is copyOnWrite)
+def evaluateBatch(system, nodes, scenarios=[{}], context=None):
+    
+    if context == None: context = EvalContext()
+    paths = context.pathIndex(system)
+    batch = []
+    
+    for scenario in scenarios:
+        context.journal = []
+        try:
+            
+            # Set this scenario's inputs, remembering what they were
+            for path in scenario:
+                handle = paths.resolve(path)
+                if handle == None:
+                    context.diagnose('invalid-input', path, 'Tried to set input %s but this wasn\'t a valid path.', path)
+                    continue
+                system = writeValue(system, handle['path'], scenario[path], context)
+            inputsSet = len(context.journal)
+            
+            # Evaluate each node. Remember its result so later nodes that reference it don't evaluate it again
+            results = {}
+            for node in nodes:
+                loopsBefore = context.loops
+                writesBefore = context.writes
+                result = parse(system, node, None, [], [], context)
+                system = result['system']
+                handle = paths.resolve(node)
+                if not handle == None: context.remember(handle['path'], result, context.loops == loopsBefore and context.writes == writesBefore)
+                results[node] = {key : result[key] for key in result if not key == 'system'}
+            
+            written = {}
+            for path, oldValue in context.journal[inputsSet:len(context.journal)]:
+                written[path] = followPath(system, path, paths)['value']
+            batch.append({'results' : results, 'written' : written})
+            
+            # With copy on write, this scenario's version of the system costs no more than what it set
+            if context.copyOnWrite: batch[len(batch)-1]['system'] = system
+        
+        # Undo every write, newest first, so the next scenario starts from the same system
+        finally:
+            journal = context.journal
+            context.journal = None
+            for path, oldValue in reversed(journal): system = writeValue(system, path, oldValue, context)
+    
+    return batch
+
+# Sets a value through a context's path index and forgets memoized results that depended on it (which
+# includes anything that read the node, the dicts containing it, or, if it was or becomes a dict, its contents)
+def writeValue(system, path, value, context):
+    paths = context.pathIndex(system)
+    oldValue = followPath(system, path, paths)['value']
+    if type(oldValue) is ColumnarRow: oldValue = dict(oldValue)
+    system = setValue(system, path, value, paths, context.copyOnWrite)
+    context.writes += 1
+    if changesWriters(oldValue, value): context.writers = None
+    context.invalidate(path, isNode(oldValue) or isNode(value))
+    for column in columnsChanged(paths, path): context.invalidate(column)
+    if not context.journal == None: context.journal.append((path, oldValue))
+    return system
+
+# Results of formula nodes kept on disk (in an SQLite database at fileName) between runs; see EvalContext
+# Each result is stored under a digest of the node's path and formula, with a digest of each value it referenced
+# and the path each symbol in the formula led to, and is only used while those are the same. Once the stored results
+# take up more than maxBytes, the least recently used are dropped. Writes are saved every saveEvery results, and by
+# flush (or close)
+# Stored values are pickled, so only open caches written by code you trust
+class ResultCache:
+    
+    def __init__(self, fileName, maxBytes=256*1024*1024, saveEvery=1000):
+        self.connection = sqlite3.connect(fileName)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, data BLOB, size INTEGER, used INTEGER)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS resultsUsed ON results (used)')
+        self.maxBytes = maxBytes
+        self.saveEvery = saveEvery
+        self.unsaved = 0
+        
+        # used counts up with every use, so the smallest are the least recently used
+        row = self.connection.execute('SELECT COALESCE(MAX(used), 0), COALESCE(SUM(size), 0) FROM results').fetchone()
+        self.used = row[0]
+        self.size = row[1]
+    
+    # The key a node's result is stored under
+    def key(self, path, formula):
+        return hashlib.sha256((path + '\0' + formula).encode('utf-8')).hexdigest()
+    
+    # The stored result under key (a dict of referenced, resolved, value, wellDefined and operators), or None
+    def get(self, key):
+        row = self.connection.execute('SELECT data FROM results WHERE key = ?', (key,)).fetchone()
+        if row == None: return None
+        self.used += 1
+        self.connection.execute('UPDATE results SET used = ? WHERE key = ?', (self.used, key))
+        self.changed()
+        return pickle.loads(row[0])
+    
+    # Store a result under key; results that can't be pickled aren't stored
+    def put(self, key, entry):
+        try: data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        except Exception: return
+        old = self.connection.execute('SELECT size FROM results WHERE key = ?', (key,)).fetchone()
+        if not old == None: self.size -= old[0]
+        self.used += 1
+        self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', (key, data, len(data), self.used))
+        self.size += len(data)
+        
+        # Drop the least recently used until we're back under the cap
+        while self.size > self.maxBytes:
+            row = self.connection.execute('SELECT key, size FROM results ORDER BY used LIMIT 1').fetchone()
+            if row == None: break
+            self.connection.execute('DELETE FROM results WHERE key = ?', (row[0],))
+            self.size -= row[1]
+        self.changed()
+    
+    def changed(self):
+        self.unsaved += 1
+        if self.unsaved >= self.saveEvery: self.flush()
+    
+    def flush(self):
+        self.connection.commit()
+        self.unsaved = 0
+    
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+# A digest of a value that's the same for equal values, whether lists are held as lists, arrays or LazyLists
+def valueDigest(value):
+    text = json.dumps(value, sort_keys=True, default=digestable)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+# What valueDigest writes for values JSON doesn't know: lists for arrays and LazyLists, otherwise their repr
+def digestable(value):
+    if hasattr(value, 'tolist'): return value.tolist()
+    if type(value) is LazyList: return list(value)
+    if isinstance(value, Mapping): return dict(value)
+    return repr(value)
+
+# A source for the value of an input, for parseAsync
+# fetch(path) must return an awaitable giving the value of the input at path (eg fetch is an async function)
+# A fetch taking longer than timeout seconds (if given) fails. Values are kept for cacheFor seconds (forever
+# if None, not at all if 0), and a path being fetched already isn't fetched again at the same time
+class InputProvider:
+    
+    def __init__(self, fetch, timeout=None, cacheFor=None):
+        self.fetch = fetch
+        self.timeout = timeout
+        self.cacheFor = cacheFor
+        
+        # path -> (value, time fetched), and path -> task fetching it
+        self.cache = {}
+        self.pending = {}
+    
+    # The value of the input at path
+    async def get(self, path):
+        
+        cached = self.cache.get(path)
+        if not cached == None and (self.cacheFor == None or time.monotonic() - cached[1] < self.cacheFor): return cached[0]
+        
+        task = self.pending.get(path)
+        if task == None:
+            task = asyncio.ensure_future(self.load(path))
+            self.pending[path] = task
+            task.add_done_callback(lambda done: self.pending.pop(path) if self.pending.get(path) is done else None)
+        return await task
+    
+    # Fetch path (within the timeout) and cache it
+    async def load(self, path):
+        value = await asyncio.wait_for(self.fetch(path), self.timeout)
+        if not self.cacheFor == 0: self.cache[path] = (value, time.monotonic())
+        return value
+
+# Same as parse, but the values of some inputs come from InputProviders (or async functions taking the path)
+# providers maps top-referenced paths to the provider of each
+# Inputs the evaluation will read are fetched at the same time, then the node is evaluated with them as inputs
+# Which inputs are read is worked out from the formulas; if evaluating reads one we didn't fetch (eg because an
+# '=' changed what's read), what it set is undone, the missing inputs are fetched, and it is evaluated again
+# If fetching an input fails or times out, it's reported as an 'input-failed' diagnostic and the system's value is used
+# diagnostics and copyOnWrite are as for EvalContext; problems are only reported from the final evaluation
+async def parseAsync(system, node, providers, toEval=None, diagnostics='log', copyOnWrite=False):
+    
+    # Key providers by shortest path
+    paths = PathIndex(system)
+    bound = {}
+    for path in providers:
+        handle = paths.resolve(path)
+        if handle == None: continue
+        provider = providers[path]
+        bound[handle['path']] = provider if type(provider) is InputProvider else InputProvider(provider)
+    
+    inputs = {}
+    failed = []
+    needed = inputsNeeded(system, node, toEval, bound, paths)
+    while True:
+        
+        # Fetch everything we know we need, all at once
+        toFetch = [path for path in needed if not path in inputs and not path in failed]
+        values = await asyncio.gather(*[bound[path].get(path) for path in toFetch], return_exceptions=True)
+        for path, value in zip(toFetch, values):
+            if isinstance(value, Exception): failed.append((path, value))
+            else: inputs[path] = value
+        failedPaths = [path for path, error in failed]
+        
+        # Evaluate, keeping problems until we know this is the last time
+        context = EvalContext(copyOnWrite=copyOnWrite, diagnostics='collect')
+        context.journal = []
+        result = parse(system, node, toEval, inputs, [], context)
+        
+        # Anything bound that was read but not fetched means going round again
+        read = set(context.readers)
+        read.update(result['referenced'])
+        handle = paths.resolve(node)
+        if not handle == None and toEval == None: read.add(handle['path'])
+        needed = [path for path in bound if path in read and not path in inputs and not path in failedPaths]
+        if len(needed) == 0: break
+        
+        # Undo what this evaluation set
+        system = result['system']
+        journal = context.journal
+        context.journal = None
+        for path, oldValue in reversed(journal): system = writeValue(system, path, oldValue, context)
+    
+    # Report problems the way the caller asked
+    reporter = EvalContext(diagnostics=diagnostics)
+    for path, error in failed:
+        reporter.diagnose('input-failed', path, 'Could not fetch input %s: %s', path, repr(error))
+    for record in result['diagnostics']: reporter.diagnose(record['code'], record['path'], '%s', record['message'])
+    result['diagnostics'] = reporter.records
+    return result
+
+# The paths in bound that evaluating node (or toEval at node) may read, following references from its formula
+# Inputs replace what's at their path, so references aren't followed through them
+def inputsNeeded(system, node, toEval, bound, paths):
+    
+    handle = paths.resolve(node)
+    if handle == None: return []
+    if toEval == None and handle['path'] in bound: return [handle['path']]
+    
+    needed = []
+    seen = set([handle['path']])
+    toVisit = formulaReferences(system, handle['path'], paths, toEval)['referenced']
+    while len(toVisit) > 0:
+        path = toVisit.pop()
+        if path in seen: continue
+        seen.add(path)
+        if path in bound: needed.append(path)
+        else: toVisit.extend(formulaReferences(system, path, paths)['referenced'])
+    return needed
+
+# Reads the formula at node (or toEval, relative to node) without evaluating it, and returns the paths it would
+# reference and the paths its '=' operations would set (as far as can be told from the system as it is now)
+# 'unresolved' has the text of each variable that looks like a path (it has a dot) but doesn't lead anywhere
+def formulaReferences(system, node, paths=None, toEval=None):
+    
+    if paths == None: paths = PathIndex(system)
+    toReturn = {'referenced' : [], 'output' : [], 'unresolved' : []}
+    handle = paths.resolve(node)
+    if handle == None: return toReturn
+    if toEval == None: toEval = handle['value']
+    if not type(toEval) == str or toEval == '': return toReturn
+    node = handle['path']
+    
+    referenced, output, unresolved = OrderedSet(), OrderedSet(), OrderedSet()
+    toVisit = [compileExpression(toEval)]
+    while len(toVisit) > 0:
+        compiled = toVisit.pop()
+        kind = compiled['kind']
+        
+        # A symbol is a reference if it's a path; otherwise it's read as a prefix expression
+        if kind == 'symbol':
+            symbolHandle = paths.resolveFrom(node, compiled['text'])
+            if not symbolHandle == None: referenced.add(symbolHandle['path'])
+            else:
+                if '.' in compiled['text']: unresolved.add(compiled['text'])
+                toVisit.append(compiled['fallback'])
+        elif kind == 'list': toVisit.extend(reversed(compiled['elements']))
+        elif kind == 'prefix':
+            
+            # '=' sets the first plain variable that is a path (unless a nested expression comes first)
+            if compiled['operator'] == '=':
+                for thisVar in compiled['variables']:
+                    if thisVar == None: break
+                    targetHandle = paths.resolveFrom(node, thisVar)
+                    if not targetHandle == None:
+                        output.add(targetHandle['path'])
+                        break
+            toVisit.extend(reversed(compiled['args']))
+    
+    toReturn['referenced'] = list(referenced)
+    toReturn['output'] = list(output)
+    toReturn['unresolved'] = list(unresolved)
+    return toReturn
+
+# Evaluates nodes (default: every leaf) by farming independent groups of them out to a concurrent.futures executor
+# Nodes are in the same group if what they (transitively) reference shares anything set by '=' or a node that
+# sets something; everything else is independent and may be evaluated at the same time
+# With a process pool (the default) each worker gets a copy of the system, and values set by '=' are copied back
+# into system in group order. With a thread pool, workers set values in system directly (groups never set the same paths)
+# diagnostics is as for EvalContext (workers report problems themselves if it's 'log')
+# Returns a dict with the system, the result of each node (as parse returns it, without 'system'), the groups, and
+# the problems found (in group order, if diagnostics is 'collect') as 'diagnostics'
+def evaluateParallel(system, nodes=None, executor=None, maxWorkers=None, diagnostics='log'):
+    
+    if nodes == None: nodes = listNodes(system)
+    graph = referenceGraph(system, nodes)
+    groups = independentGroups(system, nodes, graph)
+    
+    # Groups that read any of the same nodes go to the same task where possible, so shared nodes are
+    # evaluated once. Collect groups by the connected part of the graph they're in
+    parent = {}
+    def find(node):
+        while not parent.get(node, node) == node:
+            parent[node] = parent.get(parent[node], parent[node])
+            node = parent[node]
+        return node
+    for node in graph['edges']:
+        for nextNode in graph['edges'][node]:
+            if not find(node) == find(nextNode): parent[find(node)] = find(nextNode)
+    buckets = {}
+    for i, group in enumerate(groups):
+        handle = graph['paths'].resolve(group[0])
+        buckets.setdefault(find(handle['path']) if not handle == None else None, []).append(i)
+    
+    # One task per worker, each with a share of the buckets (biggest first, to the least loaded task)
+    ownExecutor = executor == None
+    if ownExecutor: executor = ProcessPoolExecutor(maxWorkers)
+    numTasks = max(1, min(len(groups), maxWorkers or os.cpu_count() or 1))
+    tasks = [[] for i in range(numTasks)]
+    taskSizes = [0] * numTasks
+    for bucket in sorted(buckets.values(), key=lambda bucket: -sum([len(groups[i]) for i in bucket])):
+        smallest = taskSizes.index(min(taskSizes))
+        tasks[smallest] = tasks[smallest] + bucket
+        taskSizes[smallest] += sum([len(groups[i]) for i in bucket])
+    tasks = [task for task in tasks if len(task) > 0]
+    
+    try:
+        futures = [executor.submit(evaluateGroups, system, [groups[i] for i in task], diagnostics) for task in tasks]
+        groupResults = [None] * len(groups)
+        for task, future in zip(tasks, futures):
+            for i, groupResult in zip(task, future.result()): groupResults[i] = groupResult
+    finally:
+        if ownExecutor: executor.shutdown()
+    
+    # Merge in group order, so the outcome doesn't depend on which worker finished first
+    results = {}
+    records = []
+    inPlace = isinstance(executor, ThreadPoolExecutor)
+    for groupResult in groupResults:
+        results.update(groupResult['results'])
+        records.extend(groupResult['diagnostics'])
+        if not inPlace:
+            for path in groupResult['written']: system = setValue(system, path, groupResult['written'][path])
+    
+    return {'system' : system, 'results' : {node : results[node] for node in nodes}, 'groups' : groups, 'diagnostics' : records}
+
+# Evaluates each group of nodes in order, in one pass; run by evaluateParallel's workers
+# Returns a dict per group with the result of each node, the final value of every path set by '=', and the
+# problems found while evaluating it (if diagnostics is 'collect')
+def evaluateGroups(system, groups, diagnostics='log'):
+    
+    context = EvalContext(diagnostics=diagnostics)
+    context.journal = []
+    toReturn = []
+    for group in groups:
+        results = {}
+        journalStart = len(context.journal)
+        firstRecord = len(context.records)
+        for node in group:
+            result = parse(system, node, None, [], [], context)
+            system = result['system']
+            results[node] = {key : result[key] for key in result if not key == 'system'}
+        written = {}
+        for path, oldValue in context.journal[journalStart:len(context.journal)]:
+            written[path] = followPath(system, path, context.pathIndex(system))['value']
+        toReturn.append({'results' : results, 'written' : written, 'diagnostics' : context.records[firstRecord:len(context.records)]})
+    return toReturn
+
+# Checks a system without evaluating anything: compiles every formula and resolves every path in it
+# Returns a dict of:
+    # references: node -> shortest paths its formula references
+    # outputs: node -> shortest paths its '=' operations set
+    # cycles: lists of formula nodes that (directly or not) reference each other, so evaluating any of them would
+    #         run into a loop (strongly connected components, each in the order its nodes were found)
+    # unresolved: {'node', 'reference'} for each variable that looks like a path but doesn't lead anywhere
+    # dead: if outputs are given (top-referenced paths), the leaves that can't affect them: they aren't
+    #       referenced on the way to any output, and don't set anything that is
+# Takes time linear in the size of the system and its formulas
+def analyzeSystem(system, outputs=None):
+    
+    paths = PathIndex(system)
+    analysis = {'references' : {}, 'outputs' : {}, 'cycles' : [], 'unresolved' : [], 'dead' : []}
+    nodes = listNodes(system)
+    for node in nodes:
+        found = formulaReferences(system, node, paths)
+        analysis['references'][node] = found['referenced']
+        analysis['outputs'][node] = found['output']
+        for reference in found['unresolved']: analysis['unresolved'].append({'node' : node, 'reference' : reference})
+    
+    # Evaluation only follows references to formulas (other values, including dicts, are returned as they are)
+    edges = {}
+    for node in nodes:
+        edges[node] = [path for path in analysis['references'][node] if isFormula(paths.resolve(path)['value'])]
+    for component in stronglyConnected(edges):
+        if len(component) > 1 or component[0] in edges[component[0]]: analysis['cycles'].append(component)
+    
+    if not outputs == None: analysis['dead'] = deadNodes(analysis, paths, nodes, outputs)
+    return analysis
+
+# Whether evaluating value means reading it as a formula
+def isFormula(value):
+    return type(value) == str and not value == ''
+
+# Strongly connected components of the graph node -> nodes (Tarjan's algorithm, without recursion)
+# Components come out after every component they lead to
+def stronglyConnected(edges):
+    
+    index = {}
+    lowest = {}
+    onStack = set()
+    stack = []
+    components = []
+    for start in edges:
+        if start in index: continue
+        work = [(start, 0)]
+        while len(work) > 0:
+            node, i = work.pop()
+            if i == 0:
+                index[node] = lowest[node] = len(index)
+                stack.append(node)
+                onStack.add(node)
+            
+            # Go on to the next node this one leads to, or finish it
+            following = edges.get(node, [])
+            while i < len(following) and following[i] in index:
+                if following[i] in onStack: lowest[node] = min(lowest[node], index[following[i]])
+                i += 1
+            if i < len(following):
+                work.append((node, i + 1))
+                work.append((following[i], 0))
+                continue
+            
+            # Everything this node leads to is done: tell whoever came here, and close the component if it starts here
+            if len(work) > 0:
+                caller = work[len(work)-1][0]
+                lowest[caller] = min(lowest[caller], lowest[node])
+            if lowest[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    onStack.discard(member)
+                    component.append(member)
+                    if member == node: break
+                component.reverse()
+                components.append(component)
+    return components
+
+# The leaves (of nodes) that can't affect outputs, for analyzeSystem
+def deadNodes(analysis, paths, nodes, outputs):
+    closure = upstreamClosure(paths, outputs, analysis['references'], writerIndex(analysis['outputs']))
+    return [node for node in nodes if not node in closure['live']]
+
+# Indexes the paths set by '=' (outputs maps node -> paths it sets) for upstreamClosure. Returns a dict of:
+    # setting: path -> nodes that set it
+    # inside: path -> nodes that set it or something inside it
+def writerIndex(outputs):
+    writers = {'setting' : {}, 'inside' : {}}
+    for node in outputs:
+        for path in outputs[node]:
+            writers['setting'].setdefault(path, []).append(node)
+            pathSplit = path.split('.')
+            for i in range(1, len(pathSplit)+1): writers['inside'].setdefault('.'.join(pathSplit[0:i]), []).append(node)
+    return writers
+
+# Everything that can affect targets (top-referenced paths), found without evaluating anything
+# references maps node -> shortest paths its formula references; nodes missing from it are read from
+# paths.system with formulaReferences (and added) as they're reached, so only the closure's formulas are read
+# Returns a dict of:
+    # live: set of shortest paths read on the way to targets, or that set something that is
+    # evaluated: set of the live paths that have to be evaluated (targets, what they reference, nodes that set
+    #            what's read, ...); the rest are only read as part of a dict
+    # order: the evaluated paths, each after what it reads and the nodes that set that (except around loops)
+def upstreamClosure(paths, targets, references, writers):
+    
+    live = set()
+    evaluated = set()
+    before = {}
+    starts = []
+    toVisit = []
+    for target in targets:
+        handle = paths.resolve(target)
+        if not handle == None:
+            starts.append(handle['path'])
+            toVisit.append((handle['path'], True))
+    while len(toVisit) > 0:
+        path, evaluate = toVisit.pop()
+        if path in evaluated or (path in live and not evaluate): continue
+        first = not path in live
+        live.add(path)
+        if evaluate: evaluated.add(path)
+        needs = before.setdefault(path, [])
+        found = len(needs)
+        
+        # Follow what a formula references if it's evaluated; everything inside a dict is read with it
+        handle = paths.resolve(path)
+        if isNode(handle['value']):
+            if first: needs.extend([(paths.child(handle, key)['path'], False) for key in handle['value']])
+        elif evaluate:
+            if not path in references: references[path] = formulaReferences(paths.system, path, paths)['referenced']
+            
+            # What a node sets is read when it's set, but it doesn't have to come first
+            for reference in references[path]:
+                if path in writers['setting'].get(reference, []): toVisit.append((reference, True))
+                else: needs.append((reference, True))
+
+        # A column of a ColumnarCollection is read from its cells
+        if first and type(handle['parent']['value']) is ColumnarCollection and handle['key'] in handle['parent']['value'].columns:
+            needs.append((handle['parent']['path'], False))
+        
+        # Anything that sets this, a dict containing it, or something inside it may change it
+        if first:
+            pathSplit = path.split('.')
+            for i in range(1, len(pathSplit)+1):
+                needs.extend([(writer, True) for writer in writers['setting'].get('.'.join(pathSplit[0:i]), [])])
+            needs.extend([(writer, True) for writer in writers['inside'].get(path, [])])
+        toVisit.extend(reversed(needs[found:len(needs)]))
+    
+    # Depth first from the targets, taking each path once everything it needs has been taken
+    order = []
+    done = set()
+    for start in starts:
+        if start in done: continue
+        done.add(start)
+        work = [(start, 0)]
+        while len(work) > 0:
+            path, i = work.pop()
+            needs = before[path]
+            while i < len(needs) and needs[i][0] in done: i += 1
+            if i < len(needs):
+                done.add(needs[i][0])
+                work.append((path, i + 1))
+                work.append((needs[i][0], 0))
+            elif path in evaluated: order.append(path)
+    
+    return {'live' : live, 'evaluated' : evaluated, 'order' : order}
+
+# The writerIndex of every '=' operation in system (only formulas that could hold one are read)
+# This reads the whole system, so keep the index while the system doesn't change in a way that changes it
+# (see EvalContext.writerIndex and changesWriters)
+def systemWriters(system, paths):
+    outputs = {}
+    for node in listNodes(system):
+        value = paths.resolve(node)['value']
+        if type(value) == str and '=' in value: outputs[node] = formulaReferences(system, node, paths)['output']
+    return writerIndex(outputs)
+
+# Whether setting a node from oldValue to value may change its systemWriters: if either is a formula that could
+# hold an '=', or a node (which may hold some, and where '=' paths lead can change with it)
+def changesWriters(oldValue, value):
+    for elem in (oldValue, value):
+        if isNode(elem) or (type(elem) == str and '=' in elem): return True
+    return False
+
+# Evaluates targets (top-referenced paths), and only what they need: the nodes they reference, and so on, and the
+# nodes whose '=' operations set any of those (found from the formulas as they are, see upstreamClosure)
+# Each needed node is evaluated after what it reads and the nodes that set that, sharing context's memo, and
+# the rest of the system is skipped
+# Finding the nodes that set things reads the whole system once per context, so to evaluate targets again after
+# setting inputs (with writeValue), pass the same context
+# Returns a dict with the system, the result of each target (as parse returns it, without 'system') and the
+# nodes that were evaluated, in order
+def evaluateTargets(system, targets, context=None):
+    
+    if context == None: context = EvalContext()
+    paths = context.pathIndex(system)
+    
+    closure = upstreamClosure(paths, targets, {}, context.writerIndex(system))
+    
+    order = [node for node in closure['order'] if not isNode(paths.resolve(node)['value'])]
+    nodeResults = {}
+    for node in order:
+        loopsBefore = context.loops
+        writesBefore = context.writes
+        result = parse(system, node, None, [], [], context)
+        system = result['system']
+        context.remember(node, result, context.loops == loopsBefore and context.writes == writesBefore)
+        nodeResults[node] = result
+    
+    # Targets that aren't leaves (or aren't paths) are read once the leaves are done
+    results = {}
+    for target in targets:
+        handle = context.pathIndex(system).resolve(target)
+        result = nodeResults.get(handle['path']) if not handle == None else None
+        if result == None:
+            result = parse(system, target, None, [], [], context)
+            system = result['system']
+        results[target] = {key : result[key] for key in result if not key == 'system'}
+    return {'system' : system, 'results' : results, 'evaluated' : order}
+
+# A system that tells listeners when the values of nodes they subscribed to change, instead of them polling
+# Write through setValue (or evaluate through parse, so what its '=' operations set counts as written); each
+# flush re-evaluates only the subscribed nodes (and what they need) affected by what was written since the last
+# one (see recompute), and calls each listener once with the values of its nodes that actually changed
+# Writes are flushed straight away if debounce is 0; otherwise debounce seconds after the last of a burst of
+# writes (on a timer thread), or by calling flush. Inside 'with observable:' writes are held until the end
+# Listeners are called as listener(changes), changes mapping each subscribed path (as given) to its new value
+# diagnostics is as for EvalContext; if it's 'collect', problems found evaluating (or subscribing) are kept in records
+class ObservableSystem:
+    
+    def __init__(self, system, debounce=0, diagnostics='log'):
+        
+        if not diagnostics in ('collect', 'log', 'drop'): raise ValueError('diagnostics must be collect, log or drop')
+        self.diagnostics = diagnostics
+        self.records = []
+        
+        # The dependency index covers every subscribed node and everything it needs (see buildDependencyIndex)
+        self.index = buildDependencyIndex(system, [])
+        
+        # The systemWriters of the system, made when first needed and dropped when something that may change it is set
+        self.writers = None
+        self.debounce = debounce
+        self.lock = threading.RLock()
+        self.timer = None
+        self.batches = 0
+        
+        # Paths written and not yet flushed
+        self.pending = []
+        
+        # subscription -> (listener, paths as given), shortest path -> subscriptions to it,
+        # and shortest path -> valueDigest of the value listeners last saw
+        self.subscriptions = {}
+        self.watchers = {}
+        self.digests = {}
+        self.nextSubscription = 0
+    
+    # The system as it is now (it may be a new version if evaluating with copy on write)
+    @property
+    def system(self):
+        return self.index['system']
+    
+    # Call listener with changes to the node at path (or each node of a list of paths); returns the
+    # subscription, to pass to unsubscribe. Paths that aren't valid are reported as 'invalid-path' diagnostics
+    def subscribe(self, paths, listener):
+        if type(paths) == str: paths = [paths]
+        with self.lock:
+            self.track(paths)
+            pathIndex = PathIndex(self.system)
+            subscription = self.nextSubscription
+            self.nextSubscription += 1
+            self.subscriptions[subscription] = (listener, {})
+            for path in paths:
+                handle = pathIndex.resolve(path)
+                if handle == None:
+                    self.context().diagnose('invalid-path', path, 'Tried to find %s but this wasn\'t a valid path.', path)
+                    continue
+                self.subscriptions[subscription][1][path] = handle['path']
+                self.watchers.setdefault(handle['path'], set()).add(subscription)
+                if not handle['path'] in self.digests: self.digests[handle['path']] = valueDigest(self.current(handle['path']))
+        self.flush()
+        return subscription
+    
+    def unsubscribe(self, subscription):
+        with self.lock:
+            listener, paths = self.subscriptions.pop(subscription, (None, {}))
+            for path in paths.values():
+                self.watchers[path].discard(subscription)
+                if len(self.watchers[path]) == 0:
+                    del self.watchers[path]
+                    del self.digests[path]
+    
+    # Index the nodes paths need that aren't indexed yet; what their '=' operations set is written
+    def track(self, paths):
+        pathIndex = PathIndex(self.system)
+        if self.writers == None: self.writers = systemWriters(self.system, pathIndex)
+        closure = upstreamClosure(pathIndex, paths, {}, self.writers)
+        context = self.context()
+        context.journal = []
+        for node in closure['order']:
+            if node in self.index['references'] or isNode(pathIndex.resolve(node)['value']): continue
+            loopsBefore = context.loops
+            writesBefore = context.writes
+            result = parse(self.system, node, None, [], [], context)
+            self.index['system'] = result['system']
+            indexNode(self.index, node, result, context.loops == loopsBefore and context.writes == writesBefore)
+            self.pending.extend(result['output'])
+        self.checkWriters(context.journal)
+    
+    # A context for evaluating on the index's memo, reporting problems the way this system was asked to (into records)
+    def context(self):
+        context = EvalContext(self.index['memo'], diagnostics=self.diagnostics)
+        context.records = self.records
+        return context
+    
+    # Drop the writers if anything in journal (a list of (path, old value), as EvalContext keeps) may have changed them
+    def checkWriters(self, journal):
+        for path, oldValue in journal:
+            if changesWriters(oldValue, followPath(self.system, path)['value']): self.writers = None
+    
+    # Set the value at path; listeners hear about it when it's flushed
+    def setValue(self, path, value):
+        with self.lock:
+            oldValue = followPath(self.system, path)['value']
+            self.index['system'] = setValue(self.system, path, value)
+            self.pending.append(path)
+            self.checkWriters([(path, oldValue)])
+        self.written()
+    
+    # Same as parse on the system; everything set by '=' while evaluating counts as written
+    def parse(self, node, toEval=None, context=None):
+        if context == None:
+            context = EvalContext(diagnostics=self.diagnostics)
+            context.records = self.records
+        with self.lock:
+            journal = context.journal
+            context.journal = []
+            try:
+                result = parse(self.system, node, toEval, [], [], context)
+                self.index['system'] = result['system']
+                self.pending.extend([path for path, oldValue in context.journal])
+                self.checkWriters(context.journal)
+            finally:
+                if not journal == None: journal.extend(context.journal)
+                context.journal = journal
+        self.written()
+        return result
+    
+    # Hold writes until as many releases as holds, then flush them together ('with observable:' does both)
+    def hold(self):
+        with self.lock: self.batches += 1
+    
+    def release(self):
+        with self.lock: self.batches -= 1
+        self.written()
+    
+    def __enter__(self):
+        self.hold()
+        return self
+    
+    def __exit__(self, *exc):
+        self.release()
+    
+    # Flush now, or start (or restart) the debounce timer
+    def written(self):
+        with self.lock:
+            if self.batches > 0 or len(self.pending) == 0: return
+            if self.debounce > 0:
+                if not self.timer == None: self.timer.cancel()
+                self.timer = threading.Timer(self.debounce, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+                return
+        self.flush()
+    
+    # Re-evaluate what the pending writes affect and notify listeners of values that changed
+    # Returns a dict of subscribed shortest path -> new value for every node that changed
+    def flush(self):
+        
+        with self.lock:
+            if not self.timer == None: self.timer.cancel()
+            self.timer = None
+            if len(self.pending) == 0: return {}
+            changedPaths = self.pending
+            self.pending = []
+            context = self.context()
+            context.journal = []
+            recomputed = recompute(self.index, changedPaths, context)
+            self.checkWriters(context.journal)
+            
+            # Nodes we re-evaluated, and paths written (by the caller or by '=' operations), and the dicts around them
+            touched = set(recomputed['order'])
+            for path in changedPaths:
+                handle = followPath(self.system, path)
+                if not handle['path'] == None: touched.add(handle['path'])
+            for node in recomputed['order']: touched.update(self.index['outputs'][node])
+            candidates = set()
+            for path in touched:
+                pathSplit = path.split('.')
+                for i in range(1, len(pathSplit)+1):
+                    if '.'.join(pathSplit[0:i]) in self.watchers: candidates.add('.'.join(pathSplit[0:i]))
+            for path in self.watchers:
+                pathSplit = path.split('.')
+                for i in range(1, len(pathSplit)):
+                    if '.'.join(pathSplit[0:i]) in touched: candidates.add(path)
+            
+            # Keep the ones whose value is different from what listeners last saw, and group them by listener
+            changed = {}
+            for path in candidates:
+                value = self.current(path)
+                digest = valueDigest(value)
+                if digest == self.digests[path]: continue
+                self.digests[path] = digest
+                changed[path] = value
+            notices = []
+            for subscription in self.subscriptions:
+                listener, paths = self.subscriptions[subscription]
+                changes = {path : changed[paths[path]] for path in paths if paths[path] in changed}
+                if len(changes) > 0: notices.append((listener, changes))
+        
+        # Listeners are called without the lock held, so they can write too
+        for listener, changes in notices: listener(changes)
+        return changed
+    
+    # The value of a subscribed node now
+    def current(self, path):
+        if path in self.index['results']: return self.index['results'][path]['value']
+        return followPath(self.system, path)['value']
+    
+    # Flush anything still waiting on the debounce timer
+    def close(self):
+        self.flush()
+
+# Finds everything nodes reach without evaluating anything (see formulaReferences)
+# Returns a dict with the PathIndex used ('paths') and, for every node reached, the shortest paths it
+# references or sets ('edges') and just the ones it sets ('outputs')
+def referenceGraph(system, nodes):
+    
+    paths = PathIndex(system)
+    graph = {'paths' : paths, 'edges' : {}, 'outputs' : {}}
+    toVisit = []
+    for node in nodes:
+        handle = paths.resolve(node)
+        if not handle == None: toVisit.append(handle['path'])
+    while len(toVisit) > 0:
+        node = toVisit.pop()
+        if node in graph['edges']: continue
+        references = formulaReferences(system, node, paths)
+        graph['edges'][node] = references['referenced'] + references['output']
+        graph['outputs'][node] = references['output']
+        toVisit.extend(graph['edges'][node])
+    return graph
+
+# Splits nodes into groups that can be evaluated independently (see evaluateParallel)
+# Groups keep the order nodes were given in, and are ordered by their first node
+def independentGroups(system, nodes, graph=None):
+    
+    if graph == None: graph = referenceGraph(system, nodes)
+    paths = graph['paths']
+    edges = graph['edges']
+    marked = set()
+    
+    # Nodes that set something, and what they set (plus the dicts containing it), can't be shared between groups
+    for node in edges:
+        if len(graph['outputs'][node]) > 0: marked.add(node)
+        for path in graph['outputs'][node]:
+            pathSplit = path.split('.')
+            for i in range(1, len(pathSplit)+1): marked.add('.'.join(pathSplit[0:i]))
+    
+    # For each node, the marked nodes it reaches, computed depth first without recursion
+    reaches = {}
+    visiting = set()
+    onLoop = False
+    for start in edges:
+        if start in reaches: continue
+        stack = [(start, 0)]
+        visiting.add(start)
+        while len(stack) > 0:
+            node, i = stack.pop()
+            if i < len(edges[node]):
+                stack.append((node, i+1))
+                nextNode = edges[node][i]
+                if nextNode in visiting: onLoop = True
+                elif not nextNode in reaches:
+                    visiting.add(nextNode)
+                    stack.append((nextNode, 0))
+            else:
+                visiting.discard(node)
+                reaches[node] = set([node]) if node in marked else set()
+                for nextNode in edges[node]:
+                    if nextNode in reaches: reaches[node] = reaches[node] | reaches[nextNode]
+    
+    # Nodes on a loop were finished before everything they reach was; pass sets around until nothing changes
+    while onLoop:
+        onLoop = False
+        for node in edges:
+            for nextNode in edges[node]:
+                if not reaches[nextNode] <= reaches[node]:
+                    reaches[node] = reaches[node] | reaches[nextNode]
+                    onLoop = True
+    
+    # Group nodes that reach the same marked node (union-find)
+    parent = list(range(len(nodes)))
+    def find(i):
+        while not parent[i] == i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    owner = {}
+    for i, node in enumerate(nodes):
+        handle = paths.resolve(node)
+        if handle == None: continue
+        for markedNode in reaches[handle['path']]:
+            if markedNode in owner: parent[find(i)] = find(owner[markedNode])
+            else: owner[markedNode] = i
+    
+    groups = {}
+    for i, node in enumerate(nodes): groups.setdefault(find(i), []).append(node)
+    return list(groups.values())
+
 # Assumes inputString starts with parens or brackets. Finds end parens/bracket and splits into list of two substrings
 # First is full parenthetical, second is remainder minus any leading ' '
 def findParentheticalSubstring(inputString):
@@ -594,12 +2719,231 @@ def findParentheticalSubstring(inputString):
         
 # Takes a list and removes duplicate values, so every value appears once
 def removeRedundantValues(inputList):
-    outputList = []
+    return list(OrderedSet(inputList))
+
+# A set that remembers the order elements were first added in, like a list without duplicates
+# Hashable elements are found by hash; unhashable ones (eg lists) fall back to comparing one by one
+class OrderedSet:
     
-    for elem in inputList:
-        #if outputList is []: outputList.append(elem)
-        if not elem in outputList:
-            outputList.append(elem)
-            
-    return outputList
-        
\ No newline at end of file
+    def __init__(self, elements=[]):
+        
+        # Element (or, if it's unhashable, a stand-in key) -> element, in the order they were added
+        self.members = {}
+        
+        # Stand-in keys of unhashable elements
+        self.unhashable = []
+        
+        self.update(elements)
+    
+    # Stand-in key of an unhashable element equal to elem, or None
+    def findUnhashable(self, elem):
+        for key in self.unhashable:
+            if self.members[key] == elem: return key
+        return None
+    
+    def add(self, elem):
+        try:
+            if not elem in self.members: self.members[elem] = elem
+        except TypeError:
+            if self.findUnhashable(elem) == None:
+                key = object()
+                self.unhashable.append(key)
+                self.members[key] = elem
+    
+    def update(self, elements):
+        for elem in elements: self.add(elem)
+    
+    def discard(self, elem):
+        try:
+            self.members.pop(elem, None)
+        except TypeError:
+            key = self.findUnhashable(elem)
+            if not key == None:
+                self.unhashable.remove(key)
+                del self.members[key]
+    
+    def __contains__(self, elem):
+        try:
+            return elem in self.members
+        except TypeError:
+            return not self.findUnhashable(elem) == None
+    
+    def __iter__(self):
+        return iter(self.members.values())
+    
+    def __len__(self):
+        return len(self.members)
+    
+    def __repr__(self):
+        return 'OrderedSet(' + str(list(self.members.values())) + ')'
+        
+
+# A list whose elements are only worked out when they're read
+# source is a list (or other iterable that can be read more than once), or a function returning a new iterator
+# over the elements each time it's called. Iterating reads the elements again each time rather than keeping them,
+# so memory stays the same however long the list is; indexing keeps them (see materialize)
+class LazyList:
+    
+    def __init__(self, source):
+        self.source = source
+        self.items = None
+        self.length = None
+    
+    # The elements as a list, worked out (once) if they haven't been already
+    def materialize(self):
+        if self.items == None: self.items = list(iter(self))
+        return self.items
+    
+    def __iter__(self):
+        if not self.items == None: return iter(self.items)
+        if callable(self.source): return iter(self.source())
+        return iter(self.source)
+    
+    # Counts the elements by reading them (once) unless the length is already known
+    def __len__(self):
+        if self.length == None:
+            if not self.items == None: self.length = len(self.items)
+            elif not callable(self.source) and hasattr(self.source, '__len__'): self.length = len(self.source)
+            else:
+                self.length = 0
+                for elem in self: self.length += 1
+        return self.length
+    
+    # Sequences (lists, ranges, memoryviews, ...) are indexed without reading the other elements
+    def __getitem__(self, i):
+        if self.items == None and type(i) is int and not callable(self.source) and hasattr(self.source, '__getitem__'):
+            return self.source[i]
+        return self.materialize()[i]
+    
+    def __repr__(self):
+        if self.items == None and callable(self.source): return 'LazyList(...)'
+        return 'LazyList(' + str(list(self)) + ')'
+
+# Many sibling nodes with the same fields, stored a column per field instead of a dict per node
+# keys are the row keys, in order; columns maps each field to its values (one per row, in the same order).
+# Columns of numbers are kept as typed arrays (see typedList), anything else as lists
+# Rows are addressed by the usual paths: collection.key.field is a cell, and collection.key a ColumnarRow (a view
+# of that row as a mapping of field -> value). collection.field is the whole column, so operators over a field
+# (sum, dot, union, ...) scan one array instead of walking a dict per row. Row keys and fields can't be the same
+# Iterating (and so listNodes) goes over the rows. Setting a cell, a row (to a mapping of fields), a new row or a
+# whole column changes the columns in place
+class ColumnarCollection(Mapping):
+    
+    def __init__(self, keys, columns):
+        self.rowKeys = list(keys)
+        self.rows = {key : i for i, key in enumerate(self.rowKeys)}
+        if not len(self.rows) == len(self.rowKeys): raise ValueError('row keys must be unique')
+        self.columns = {}
+        for field in columns: self.setColumn(field, columns[field])
+    
+    def __getitem__(self, key):
+        i = self.rows.get(key)
+        if not i == None: return ColumnarRow(self, i)
+        return self.columns[key]
+    
+    def __contains__(self, key):
+        return key in self.rows or key in self.columns
+    
+    def __iter__(self):
+        return iter(self.rowKeys)
+    
+    def __len__(self):
+        return len(self.rowKeys)
+    
+    # Setting a row replaces all of it: fields value doesn't have become None
+    def __setitem__(self, key, value):
+        if key in self.columns:
+            self.setColumn(key, value)
+            return
+        if not isinstance(value, Mapping): raise TypeError('a row must be a mapping of fields')
+        
+        # A new row goes on the end of every column
+        if not key in self.rows:
+            self.rows[key] = len(self.rowKeys)
+            self.rowKeys.append(key)
+            for field in self.columns:
+                column = self.columns[field]
+                if type(column) is array.array:
+                    typed = typedList([value[field]]) if field in value else None
+                    if typed == None or not typed.typecode == column.typecode: column = list(column)
+                else: column = self.writable(field)
+                column.append(value.get(field))
+                self.columns[field] = column
+        
+        for field in self.columns:
+            if not field in value: self.setCell(self.rows[key], field, None)
+        for field in value: self.setCell(self.rows[key], field, value[field])
+    
+    # Set the values of a whole column (adding it if it's new)
+    # Typed arrays and LazyLists (eg arrays kstore loaded) are used as they are; they're copied when a cell is set
+    def setColumn(self, field, values):
+        if field in self.rows: raise ValueError('field ' + repr(field) + ' is also a row key')
+        if not type(values) is array.array and not type(values) is LazyList:
+            values = list(values)
+            typed = typedList(values)
+            if not typed == None: values = typed
+        if not len(values) == len(self.rowKeys): raise ValueError('column ' + repr(field) + ' needs a value for every row')
+        self.columns[field] = values
+    
+    # Set one cell (adding the field if it's new). Typed columns stay typed while values of their type are set
+    def setCell(self, i, field, value):
+        if not field in self.columns: self.setColumn(field, [None] * len(self.rowKeys))
+        column = self.columns[field]
+        typed = typedList([value])
+        if type(column) is array.array and not typed == None and typed.typecode == column.typecode:
+            column[i] = value
+            return
+        column = self.writable(field)
+        column[i] = value
+        self.columns[field] = column
+    
+    # The column for field as a list that can be changed
+    def writable(self, field):
+        column = self.columns[field]
+        if type(column) is list: return column
+        return list(column)
+    
+    # A copy whose columns can be changed without changing these
+    def copy(self):
+        columns = {}
+        for field in self.columns:
+            column = self.columns[field]
+            if type(column) is array.array: columns[field] = array.array(column.typecode, column)
+            elif type(column) is list: columns[field] = list(column)
+            else: columns[field] = column
+        return ColumnarCollection(self.rowKeys, columns)
+    
+    def __repr__(self):
+        return 'ColumnarCollection(' + repr(self.rowKeys) + ', ' + repr(self.columns) + ')'
+
+# One row of a ColumnarCollection, as a mapping of field -> value
+class ColumnarRow(Mapping):
+    
+    def __init__(self, collection, i):
+        self.collection = collection
+        self.i = i
+    
+    def __getitem__(self, field):
+        return self.collection.columns[field][self.i]
+    
+    def __contains__(self, field):
+        return field in self.collection.columns
+    
+    def __iter__(self):
+        return iter(self.collection.columns)
+    
+    def __len__(self):
+        return len(self.collection.columns)
+    
+    def __setitem__(self, field, value):
+        self.collection.setCell(self.i, field, value)
+    
+    def __repr__(self):
+        return repr(dict(self))
+
+# A ColumnarCollection holding rows (a mapping of row key -> mapping of field -> value); fields a row doesn't
+# have are None
+def columnsFromRows(rows):
+    fields = OrderedSet()
+    for key in rows: fields.update(list(rows[key]))
+    return ColumnarCollection(list(rows), {field : [rows[key].get(field) for key in rows] for field in fields})
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact on-disk format for kparse systems
+"""
+
+# A stored system is one file:
+    # magic: 8 bytes, 'KSYS' and the format version (4 bytes, big endian)
+    # skeleton: its length (8 bytes, little endian), then a marshal dump of a dict of
+        # system: the system, with each large numeric list swapped for ('kstore.array', number of the array), and
+        #         each ColumnarCollection for ('kstore.columns', row keys, columns) (columns stored the same way)
+        # nodes: the top-referenced path of every leaf, as listNodes gives them
+        # compiled: formula text -> compiled tree (see kparse.compileExpression) for every string in the system
+        # operators: the operators they were compiled with (see operatorSignature)
+        # arrays: (offset, length, typecode) of each array, in the order they're numbered
+        # byteorder: the byte order the arrays were written in
+    # arrays: the large numeric lists, as contiguous machine doubles ('d') or 64 bit ints ('q'), 8 byte aligned
+# Loading reads the skeleton, and memory maps the arrays. By default each array is copied out of the map into a typed
+# array (as kparse.normalizeSystem gives), so loading reads every array. Only loading lazily opens the file in time
+# that doesn't grow with the arrays: each is a LazyList over a memoryview of the file, so an array isn't read from
+# disk until something uses it, and only the pages that are used are read
+# The skeleton is read with marshal, so only load files from sources you trust
+
+import sys
+import mmap
+import array
+import marshal
+
+import kparse
+
+
+# Version 2 added ColumnarCollections ('kstore.columns'), which version 1 readers would misread, so they refuse
+# version 2 files. Version 1 files are version 2 files without collections, so they're still read
+formatVersion = 2
+readableVersions = (1, 2)
+magic = b'KSYS' + formatVersion.to_bytes(4, 'big')
+
+# Lists at least this long, of only ints or only floats, are stored as arrays
+arrayThreshold = 64
+
+
+# Write system to fileName
+def saveSystem(system, fileName, threshold=None):
+
+    if threshold == None: threshold = arrayThreshold
+    arrays = []
+    compiled = {}
+    skeleton = {'system' : stripArrays(system, arrays, compiled, threshold), 'nodes' : kparse.listNodes(system),
+                'compiled' : compiled, 'operators' : operatorSignature(), 'arrays' : [], 'byteorder' : sys.byteorder}
+
+    # Offsets are counted from the start of the array section (after the skeleton, aligned to 8 bytes), so they
+    # can go in the skeleton before we know how long it is
+    offset = 0
+    for values in arrays:
+        skeleton['arrays'].append((offset, len(values), values.typecode))
+        offset += len(values) * values.itemsize
+    data = marshal.dumps(skeleton)
+    start = len(magic) + 8 + len(data)
+    padding = (8 - start % 8) % 8
+
+    with open(fileName, 'wb') as f:
+        f.write(magic)
+        f.write(len(data).to_bytes(8, 'little'))
+        f.write(data)
+        f.write(b'\x00' * padding)
+        for values in arrays: values.tofile(f)
+
+# Copy of value with large numeric lists replaced by placeholders (their arrays are appended to arrays)
+# Each string found is compiled into compiled
+def stripArrays(value, arrays, compiled, threshold):
+
+    if type(value) == dict:
+        return {key : stripArrays(value[key], arrays, compiled, threshold) for key in value}
+    
+    # Numeric columns are arrays however short they are
+    if type(value) is kparse.ColumnarCollection:
+        return ('kstore.columns', list(value.rowKeys),
+                {field : stripArrays(value.columns[field], arrays, compiled, 0) for field in value.columns})
+
+    if type(value) == str:
+        if not value == '' and not value in compiled: compiled[value] = kparse.compileExpression(value)
+        return value
+
+    # Arrays we loaded can be written straight back
+    if type(value) is kparse.LazyList and type(value.source) is memoryview and value.items == None:
+        arrays.append(array.array(value.source.format, value.source))
+        return ('kstore.array', len(arrays) - 1)
+    if type(value) is kparse.LazyList: value = list(value)
+    
+    # Typed arrays (from kparse.normalizeSystem) stay typed however short they are
+    if type(value) is array.array:
+        arrays.append(value if value.typecode in ('d', 'q') else array.array('d', value))
+        return ('kstore.array', len(arrays) - 1)
+
+    if type(value) is list:
+        typecode = arrayType(value) if len(value) >= threshold else None
+        if typecode == None: return [stripArrays(elem, arrays, compiled, threshold) for elem in value]
+        arrays.append(array.array(typecode, value))
+        return ('kstore.array', len(arrays) - 1)
+
+    return value
+
+# The registered operators, as a sorted list of (symbol, typing, arity, name of the function applying it)
+# Compiled trees depend on these (text reads as an operator or not, and constants are folded with the functions)
+def operatorSignature():
+    signature = []
+    for symbol in kparse.operatorRegistry:
+        entry = kparse.operatorRegistry[symbol]
+        func = entry['func']
+        name = None if func == None else getattr(func, '__module__', '') + '.' + getattr(func, '__qualname__', repr(func))
+        signature.append((symbol, entry['typing'], entry['arity'], name))
+    return sorted(signature, key=lambda operator: operator[0])
+
+# 'q' if values are all ints that fit in 64 bits, 'd' if they're all floats, otherwise None
+def arrayType(values):
+    if all(type(elem) is int for elem in values):
+        if all(-2**63 <= elem < 2**63 for elem in values): return 'q'
+        return None
+    if all(type(elem) is float for elem in values): return 'd'
+    return None
+
+# Open a system written by saveSystem
+# If compiled, the stored compiled formulas are put in kparse's compile cache (as many as fit in it), unless the
+# operators registered now aren't the ones they were compiled with (then formulas are compiled as they're used)
+# If normalize, literal values are given their types (see kparse.normalizeSystem) as they're loaded
+# If lazy, arrays are left in the file until they're used, as LazyLists; evaluate the system with
+# EvalContext(lazy=True) (or vectorize=True), so lists are LazyLists (or arrays) however they were read
+# Otherwise every array is copied out of the file while loading
+# Returns a dict of:
+    # system: the system, with arrays as typed arrays, or if lazy as LazyLists over the memory mapped file
+    # nodes: the top-referenced path of every leaf
+    # index: a PathIndex for the system, to pass on in an EvalContext (context.paths) or to followPath
+def loadSystem(fileName, compiled=True, normalize=False, lazy=False):
+
+    with open(fileName, 'rb') as f:
+        header = f.read(len(magic))
+        if not header[0:4] == magic[0:4]: raise ValueError(fileName + ' is not a stored system')
+        version = int.from_bytes(header[4:8], 'big')
+        if not version in readableVersions:
+            raise ValueError(fileName + ' is stored in format version ' + str(version) + ', which this kstore can\'t read')
+        size = int.from_bytes(f.read(8), 'little')
+        skeleton = marshal.loads(f.read(size))
+
+        # Map the file only if there's something to map; the map stays open while any array from it is in use
+        views = []
+        if len(skeleton['arrays']) > 0:
+            if not skeleton['byteorder'] == sys.byteorder: raise ValueError(fileName + ' was written with a different byte order')
+            start = len(magic) + 8 + size
+            start += (8 - start % 8) % 8
+            buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            for offset, length, typecode in skeleton['arrays']:
+                begin = start + offset
+                views.append(buffer[begin : begin + length * 8].cast(typecode))
+
+    if compiled and skeleton.get('operators') == operatorSignature():
+        with kparse.compileLock:
+            for text in skeleton['compiled']:
+                if len(kparse.compileCache) >= kparse.compileCacheSize: break
+                if not text in kparse.compileCache: kparse.compileCache[text] = skeleton['compiled'][text]
+
+    system = restoreArrays(skeleton['system'], views, lazy)
+    if normalize: kparse.normalizeSystem(system)
+    return {'system' : system, 'nodes' : skeleton['nodes'], 'index' : kparse.PathIndex(system)}
+
+# Put the arrays and collections back in place of their placeholders (in place), and return value
+def restoreArrays(value, views, lazy):
+    if type(value) == dict:
+        for key in value: value[key] = restoreArrays(value[key], views, lazy)
+    elif type(value) is list:
+        for i, child in enumerate(value): value[i] = restoreArrays(child, views, lazy)
+    elif type(value) is tuple and len(value) == 2 and value[0] == 'kstore.array':
+        view = views[value[1]]
+        return kparse.LazyList(view) if lazy else array.array(view.format, view)
+    elif type(value) is tuple and len(value) == 3 and value[0] == 'kstore.columns':
+        return kparse.ColumnarCollection(value[1], restoreArrays(value[2], views, lazy))
+    return value
@@ -0,0 +1,627 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Behavior tests for kparse (run with pytest)
+"""
+
+# Most tests compare what a feature gives with what a fresh parse of the same system gives
+
+import sys
+import copy
+import asyncio
+import random
+import array
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import kparse
+
+
+# The value and wellDefined a fresh parse (new context, copy of system) gives for node
+def fresh(system, node):
+    result = kparse.parse(copy.deepcopy(system), node, context=kparse.EvalContext())
+    return (result['value'], result['wellDefined'])
+
+
+########################## Memoization ##########################
+
+# A reference whose evaluation sets something (even through another reference) isn't memoized,
+# so the second read does the write again
+def testWritesThroughMemoizedReferences():
+    system = {'w' : 1, 'z' : '(= parent.w 5)', 'y' : 'parent.z', 'top' : '[parent.y,(= parent.w 2),parent.y,parent.w]'}
+    result = kparse.parse(system, 'top')
+    assert result['value'][3] == 5.0
+    assert result['system']['w'] == 5.0
+
+def testWritesThroughMemoizedReferencesInBatch():
+    system = {'w' : 1, 'z' : '(= parent.w 5)', 'y' : 'parent.z', 'reset' : '(= parent.w 2)', 'read' : '[parent.y,parent.w]'}
+    out = kparse.evaluateBatch(system, ['y', 'reset', 'read'])
+    assert out[0]['results']['read']['value'][1] == 5.0
+
+
+########################## Result cache ##########################
+
+# A result stored before a path it reads existed isn't used once the path is there
+def testResultCacheWhenPathAppears():
+    cache = kparse.ResultCache(':memory:')
+    system = {'a' : 5, 'f' : '(+ parent.b 1)', 'g' : 'parent.f'}
+    assert kparse.parse(system, 'f', context=kparse.EvalContext(diagnostics='drop', resultCache=cache))['value'] == None
+    assert kparse.parse(system, 'g', context=kparse.EvalContext(diagnostics='drop', resultCache=cache))['value'] == None
+    
+    system['b'] = 5
+    for node in ['f', 'g']:
+        result = kparse.parse(system, node, context=kparse.EvalContext(diagnostics='drop', resultCache=cache))
+        assert (result['value'], result['wellDefined']) == fresh(system, node) == (6.0, True)
+
+# Nor once a path it reads leads somewhere else, or a value it read has changed
+def testResultCacheWhenPathChanges():
+    cache = kparse.ResultCache(':memory:')
+    system = {'x' : 1, 'inner' : {'x' : 2, 'f' : '(+ parent.x 10)'}, 'g' : '(* parent.inner.f 2)'}
+    assert kparse.parse(system, 'g', context=kparse.EvalContext(resultCache=cache))['value'] == 24.0
+    
+    system['inner']['x'] = 3
+    assert kparse.parse(system, 'g', context=kparse.EvalContext(resultCache=cache))['value'] == fresh(system, 'g')[0] == 26.0
+    
+    system['inner'] = {'f' : '(+ parent.parent.x 10)'}
+    assert kparse.parse(system, 'g', context=kparse.EvalContext(resultCache=cache))['value'] == fresh(system, 'g')[0] == 22.0
+    
+    # And is used while nothing has changed
+    context = kparse.EvalContext(resultCache=cache)
+    assert kparse.parse(system, 'g', context=context)['value'] == 22.0
+    assert context.outdated == set()
+
+
+########################## Demand-driven evaluation ##########################
+
+# Evaluating targets again with the same context follows writes made through it, including new '=' operations
+def testTargetsWithSameContext():
+    system = {'a' : 1, 'b' : '(+ parent.a 1)', 'c' : '(* parent.b 2)', 'other' : '(+ parent.a 100)', 'w' : 0}
+    context = kparse.EvalContext()
+    result = kparse.evaluateTargets(system, ['c'], context)
+    assert result['results']['c']['value'] == fresh(system, 'c')[0] == 4.0
+    assert result['evaluated'] == ['a', 'b', 'c']
+    
+    system = kparse.writeValue(system, 'a', 5, context)
+    assert kparse.evaluateTargets(system, ['c'], context)['results']['c']['value'] == 12.0
+    
+    system = kparse.writeValue(system, 'w', '(= parent.a 10)', context)
+    result = kparse.evaluateTargets(system, ['c'], context)
+    assert result['results']['c']['value'] == 22.0
+    assert 'w' in result['evaluated']
+
+# A subscribed node hears about changes made by an '=' that was written after it subscribed
+def testObservableSeesNewWriters():
+    system = {'a' : 1, 'b' : '(+ parent.a 1)', 'w' : 0, 'x' : 3}
+    observable = kparse.ObservableSystem(system)
+    heard = []
+    observable.subscribe('b', heard.append)
+    observable.setValue('a', 2)
+    assert heard == [{'b' : 3.0}]
+    
+    # Subscribing again tracks the new '=' (which sets a to 3), and both subscriptions hear about it
+    observable.setValue('w', '(= parent.a parent.x)')
+    observable.subscribe('b', heard.append)
+    assert heard[1:] == [{'b' : 4.0}, {'b' : 4.0}]
+    
+    observable.setValue('x', 7)
+    assert heard[3:] == [{'b' : 8.0}, {'b' : 8.0}]
+    assert fresh(observable.system, 'b')[0] == 8.0
+
+
+########################## Operators ##########################
+
+# A registered operator is evaluated through its registry entry, and the operator tables follow the registry
+def testRegisteredOperator():
+    kparse.registerOperator('maximum', lambda A, B: max(float(A), float(B)), 2)
+    try:
+        assert kparse.parse({'a' : '(maximum [1,5] [2,3])'}, 'a')['value'] == [2.0, 5.0]
+        assert kparse.binaryOpsNumsDict['maximum'] is kparse.operatorRegistry['maximum']['func']
+        
+        kparse.registerOperator('maximum', lambda A: max(A), 1, 'sets')
+        assert kparse.parse({'a' : '(maximum [2,7,3])'}, 'a')['value'] == 7
+        assert not 'maximum' in kparse.binaryOpsNumsDict and 'maximum' in kparse.unaryOpsSetsDict
+    finally:
+        del kparse.operatorRegistry['maximum']
+        kparse.operators.remove('maximum')
+        kparse.compileCache.clear()
+
+# operate still takes an operator dict, a symbol and an argument count, as it did before the registry
+def testOperateWithDict():
+    assert kparse.operate(kparse.binaryOpsNumsDict, '+', 2, [True, True, True], [1, 2, 4])['value'] == 7.0
+    assert kparse.operate(kparse.unaryOpsSetsDict, 'sum', 1, [True], [[1, 2, 4]])['value'] == 7
+    assert kparse.operate({'+' : lambda A, B: A * B}, '+', 2, [True, True], [3, 4])['value'] == 12
+    assert kparse.operate(kparse.binaryOpsNumsDict, '+', 2, [True, False], [1, None])['wellDefined'] == False
+
+
+########################## Shared subexpressions and folding ##########################
+
+def sharingSystem():
+    return {'a' : 1, 'b' : 2, 'x' : '(* (+ parent.a parent.b) 2)', 'y' : '(- (+ parent.a parent.b) 1)',
+            'z' : '[(+ parent.a parent.b),parent.a]', 'w' : '(= parent.a 10)', 'inner' : {'a' : 5, 'b' : 7, 'c' : '(+ parent.a parent.b)'}}
+
+# A subexpression appearing in several formulas, reading the same paths, is evaluated once per pass
+def testSharedSubexpressions():
+    system = sharingSystem()
+    optimized = kparse.optimizeSystem(system)
+    assert optimized['shared'] == set(['(+ parent.a parent.b)'])
+    
+    profiler = kparse.Profiler()
+    context = kparse.EvalContext(shared=optimized['shared'], profiler=profiler)
+    for node in ['x', 'y', 'z']:
+        result = kparse.parse(system, node, context=context)
+        assert (result['value'], result['wellDefined']) == fresh(system, node), node
+    assert profiler.operators['+']['count'] == 1
+    
+    # Where it reads other paths it's evaluated again
+    result = kparse.parse(system, 'inner.c', context=context)
+    assert profiler.operators['+']['count'] == 2
+    assert result['value'] == fresh(system, 'inner.c')[0] == 12.0
+
+# Setting something it read between two uses means evaluating it again
+def testSharedSubexpressionAfterWrite():
+    system = sharingSystem()
+    profiler = kparse.Profiler()
+    context = kparse.EvalContext(shared=kparse.optimizeSystem(system)['shared'], profiler=profiler)
+    assert kparse.parse(system, 'x', context=context)['value'] == 6.0
+    kparse.parse(system, 'w', context=context)
+    assert kparse.parse(system, 'y', context=context)['value'] == fresh(system, 'y')[0] == 11.0
+    assert profiler.operators['+']['count'] == 2
+
+# And a result whose evaluation set something isn't kept, so the write happens again
+def testSharedSubexpressionThatWrites():
+    system = {'n' : 0, 'count' : '[(= parent.n (+ parent.n 1)),parent.n]', 'both' : '[(cardinality parent.count),(cardinality parent.count)]'}
+    context = kparse.EvalContext(shared=set(['(cardinality parent.count)']))
+    result = kparse.parse(copy.deepcopy(system), 'both', context=context)
+    assert (result['value'], result['wellDefined']) == fresh(system, 'both')
+    assert result['system']['n'] == kparse.parse(copy.deepcopy(system), 'both')['system']['n'] == 2.0
+
+# The same tree with every folded constant put back as the expression it was folded from
+def unfolded(compiled):
+    if compiled['kind'] == 'constant': compiled = compiled['prefix']
+    compiled = dict(compiled)
+    for key in ('args', 'elements'):
+        if key in compiled: compiled[key] = [unfolded(part) for part in compiled[key]]
+    if compiled['kind'] == 'symbol': compiled['fallback'] = unfolded(compiled['fallback'])
+    return compiled
+
+# Folding constants doesn't change the value, operators or wellDefined of any formula
+def testFoldedConstants():
+    system = {'a' : 4, 'f' : '(+ 1 (* 2 3))', 'g' : '(+ parent.a (* 2 3))', 'h' : '(== 1 1)', 'i' : '(+ 1 nothing)',
+              'j' : '[(- 5 2),(% 7 2)]', 'k' : '(+ 1 [2,3])', 'l' : '(* parent.a (- 3 3))'}
+    assert sorted(kparse.optimizeSystem(system)['folded']) == ['(% 7 2)', '(* 2 3)', '(+ 1 (* 2 3))', '(- 3 3)', '(- 5 2)', '(== 1 1)']
+    for node in system:
+        if not type(system[node]) == str: continue
+        folded = kparse.parse(system, node, context=kparse.EvalContext(diagnostics='drop'))
+        compiled = unfolded(kparse.compileExpression(system[node]))
+        plain = kparse.evaluate(system, node, compiled, {}, [], kparse.EvalContext(diagnostics='drop'))
+        for key in ['value', 'operators', 'wellDefined', 'referenced']: assert folded[key] == plain[key], (node, key)
+
+
+########################## Incremental recomputation ##########################
+
+def layeredSystem():
+    system = {'a' : 1, 'b' : 2, 'inputs' : {'x' : 3, 'y' : [1, 2, 3]}, 't' : 0,
+              'w' : '(= parent.t (+ parent.a 100))', 'fromT' : '(* parent.t 2)', 'all' : 'parent.inputs'}
+    for i in range(10):
+        system['l' + str(i)] = {'p' : '(+ parent.parent.a ' + str(i) + ')', 'q' : '(* parent.p parent.parent.inputs.x)',
+                                'r' : '(sum (+ parent.parent.inputs.y parent.q))', 'unrelated' : '(* parent.parent.b 3)'}
+    return system
+
+# After changes, every node recompute re-evaluated (and every one it left alone) has the value a fresh parse gives
+def testRecomputeMatchesFreshParse():
+    index = kparse.buildDependencyIndex(layeredSystem())
+    for path, value in [('a', 5), ('inputs.x', 10), ('inputs.y', [4, 5]), ('inputs', {'x' : 1, 'y' : [1]}), ('b', 7)]:
+        index['system'] = kparse.setValue(index['system'], path, value)
+        recomputed = kparse.recompute(index, [path])
+        for node in index['results']:
+            assert (index['results'][node]['value'], index['results'][node]['wellDefined']) == fresh(index['system'], node), (path, node)
+        
+        # Only what reads the change is evaluated again
+        if path == 'b': assert sorted(recomputed['order']) == sorted(['b'] + ['l' + str(i) + '.unrelated' for i in range(10)])
+    assert index['results']['fromT']['value'] == 210.0
+    
+    # Results of nodes that set something aren't reused when other nodes read them, so the write happens again
+    system = {'k' : 0, 'w' : 1, 'z' : '(= parent.w 5)', 'y' : 'parent.z', 'top' : '[parent.k,parent.y,(= parent.w 2),parent.y,parent.w]'}
+    index = kparse.buildDependencyIndex(copy.deepcopy(system))
+    assert index['results']['top']['value'][4] == fresh(system, 'top')[0][4] == 5.0
+    index['system'] = kparse.setValue(index['system'], 'k', 3)
+    kparse.recompute(index, ['k'])
+    assert (index['results']['top']['value'], index['results']['top']['wellDefined']) == fresh(index['system'], 'top')
+    assert index['results']['top']['value'][4] == 5.0
+
+def testRecomputeOrder():
+    index = kparse.buildDependencyIndex({'a' : 1, 'c' : '(+ parent.b 1)', 'b' : '(* parent.a 2)', 'd' : '[parent.c,parent.b]'})
+    index['system'] = kparse.setValue(index['system'], 'a', 3)
+    recomputed = kparse.recompute(index, ['a'])
+    order = recomputed['order']
+    assert order.index('b') < order.index('c') < order.index('d')
+    assert recomputed['values']['d'] == [7.0, 6.0]
+
+
+########################## Deep systems ##########################
+
+# Chains of references far longer than Python's recursion limit evaluate without recursing
+def testLongChain():
+    system = {'n0' : 1}
+    for i in range(1, 20000): system['n' + str(i)] = '(+ parent.n' + str(i-1) + ' 1)'
+    result = kparse.parse(system, 'n19999')
+    assert (result['value'], result['wellDefined']) == (20000.0, True)
+    assert result['referenced'] == ['n19998']
+
+def testLongCycle():
+    system = {'n0' : 'parent.n19999'}
+    for i in range(1, 20000): system['n' + str(i)] = 'parent.n' + str(i-1)
+    result = kparse.parse(system, 'n19999', context=kparse.EvalContext(diagnostics='collect'))
+    assert result['value'] == None
+    assert [record['code'] for record in result['diagnostics']] == ['loop']
+
+# Nodes nested thousands of levels deep, each reading the level around it through parent
+def testDeepNesting():
+    system = {'x' : 1}
+    level = system
+    node = 'x'
+    for i in range(1, 3000):
+        level['c'] = {'x' : '(+ parent.parent.x 1)'}
+        level = level['c']
+        node = 'c.' + node
+    assert kparse.parse(system, node)['value'] == 3000.0
+
+# Profiling a long chain keeps one frame per node (and per lookup and operator in it), not one stack key per depth
+def testProfiledLongChain():
+    system = {'n0' : 1}
+    for i in range(1, 20000): system['n' + str(i)] = '(+ parent.n' + str(i-1) + ' 1)'
+    profiler = kparse.Profiler()
+    assert kparse.parse(system, 'n19999', context=kparse.EvalContext(profiler=profiler))['value'] == 20000.0
+    assert len(profiler.frames) == len(profiler.stacks) == 3 * 20000 - 2
+    assert profiler.report()['nodes']['n0']['count'] == 1
+    
+    # Stacks are written out in full in the folded format
+    ticks = itertools.count()
+    profiler = kparse.Profiler(clock=lambda: next(ticks))
+    kparse.parse({'a' : 1, 'b' : '(+ parent.a 1)', 'c' : '(* parent.b 2)'}, 'c', context=kparse.EvalContext(profiler=profiler))
+    assert sorted(profiler.folded(scale=1).split('\n')) == ['c 4', 'c;(*) 1', 'c;(lookup) 1', 'c;b 4', 'c;b;(+) 1',
+                                                              'c;b;(lookup) 1', 'c;b;a 1']
+
+# Stored results are used by later runs while nothing they depend on (however far back) has changed
+def testResultCacheBetweenRuns(tmp_path):
+    fileName = str(tmp_path / 'results.db')
+    system = {'a' : 2, 'b' : '(* parent.a 3)', 'c' : '(+ parent.b 1)', 'd' : '[parent.c,parent.b]'}
+    cache = kparse.ResultCache(fileName)
+    assert kparse.parse(system, 'd', context=kparse.EvalContext(resultCache=cache))['value'] == [7.0, 6.0]
+    cache.close()
+    
+    # Nothing changed, so nothing is evaluated
+    cache = kparse.ResultCache(fileName)
+    profiler = kparse.Profiler()
+    assert kparse.parse(system, 'd', context=kparse.EvalContext(resultCache=cache, profiler=profiler))['value'] == [7.0, 6.0]
+    assert profiler.report()['nodes'] == {}
+    
+    # A change two references back, and a changed formula, are both seen
+    system['a'] = 5
+    assert kparse.parse(system, 'd', context=kparse.EvalContext(resultCache=cache))['value'] == fresh(system, 'd')[0] == [16.0, 15.0]
+    system['b'] = '(* parent.a 4)'
+    assert kparse.parse(system, 'd', context=kparse.EvalContext(resultCache=cache))['value'] == fresh(system, 'd')[0] == [21.0, 20.0]
+    cache.close()
+
+
+########################## Columnar collections ##########################
+
+def itemRows(n):
+    return {'item' + str(i) : {'price' : float(i % 7 + 1), 'qty' : i % 4, 'name' : 'n' + str(i),
+                               'total' : '(* parent.price parent.qty)'} for i in range(n)}
+
+def itemSystems(n):
+    plain = {'items' : itemRows(n), 'tax' : 0.5, 'first' : '(+ parent.items.item3.total parent.tax)',
+             'row' : 'parent.items.item2', 'up' : '(+ parent.items.item1.parent.item4.qty 1)'}
+    columnar = dict(copy.deepcopy(plain))
+    columnar['items'] = kparse.columnsFromRows(itemRows(n))
+    return plain, columnar
+
+# Every node of a collection reads and evaluates the same as in the dicts it was made from
+def testColumnarMatchesRows():
+    plain, columnar = itemSystems(20)
+    assert kparse.listNodes(columnar) == kparse.listNodes(plain)
+    for node in kparse.listNodes(plain):
+        assert fresh(columnar, node) == fresh(plain, node), node
+        assert kparse.formulaReferences(columnar, node) == kparse.formulaReferences(plain, node), node
+    assert dict(columnar['items']['item2']) == plain['items']['item2']
+    assert {key : dict(row) for key, row in columnar['items'].items()} == plain['items']
+    assert kparse.parse(columnar, 'row')['value'] == plain['items']['item2']
+
+# A field of a collection is its whole column, and operators read it as a list
+def testColumns():
+    plain, columnar = itemSystems(20)
+    prices = [row['price'] for row in plain['items'].values()]
+    quantities = [row['qty'] for row in plain['items'].values()]
+    assert list(kparse.followPath(columnar, 'items.price')['value']) == prices
+    assert kparse.parse(columnar, 'items', '(sum price)')['value'] == sum(prices)
+    columnar['dot'] = '(dot parent.items.price parent.items.qty)'
+    assert kparse.parse(columnar, 'dot')['value'] == sum(p * q for p, q in zip(prices, quantities))
+
+# Writing cells, rows and columns (with and without an index, and with copy on write) changes the collection
+# as the same writes would change the dicts
+def testColumnarWrites():
+    for index in [False, True]:
+        plain, columnar = itemSystems(5)
+        paths = kparse.PathIndex(columnar) if index else None
+        for path, value in [('items.item1.price', 9.5), ('items.item2.qty', 'abc'), ('items.item3', {'price' : 1.5, 'qty' : 2, 'name' : 'x', 'total' : 4})]:
+            kparse.setValue(plain, path, copy.deepcopy(value))
+            kparse.setValue(columnar, path, copy.deepcopy(value), paths)
+            assert {key : dict(row) for key, row in columnar['items'].items()} == plain['items']
+            if index: assert kparse.followPath(columnar, path, paths)['value'] == kparse.followPath(plain, path)['value']
+        
+        kparse.setValue(columnar, 'items.qty', [7, 7, 7, 7, 7], paths)
+        assert [row['qty'] for row in columnar['items'].values()] == [7] * 5
+        
+        before = {key : dict(row) for key, row in columnar['items'].items()}
+        changed = kparse.setValue(columnar, 'items.item0.qty', 42, paths, copyOnWrite=True)
+        assert changed['items']['item0']['qty'] == 42
+        assert {key : dict(row) for key, row in columnar['items'].items()} == before
+
+# Setting a cell with '=' invalidates what read its column earlier in the pass
+def testColumnarAssignment():
+    plain, columnar = itemSystems(5)
+    columnar.update({'before' : '(sum parent.items.qty)', 'w' : '(= parent.items.item1.qty 100)', 'after' : '(sum parent.items.qty)'})
+    context = kparse.EvalContext()
+    values = [kparse.parse(columnar, node, context=context)['value'] for node in ['before', 'w', 'after']]
+    assert values[0] == 6.0 and values[2] == 105.0
+    assert kparse.followPath(columnar, 'items.item1.total')['value'] == '(* parent.price parent.qty)'
+    assert kparse.parse(columnar, 'items.item1.total')['value'] == 200.0
+
+# Recomputation, subscriptions and demand-driven evaluation see writes to cells as writes to their columns
+def testColumnarDependencies():
+    plain, columnar = itemSystems(5)
+    columnar.update({'s' : '(sum parent.items.price)', 'setp' : '(= parent.items.item0.price parent.p)', 'p' : 10.0})
+    
+    result = kparse.evaluateTargets(copy.deepcopy(columnar), ['s'])
+    assert result['evaluated'] == ['p', 'setp', 'items.item0.price', 'items.price', 's']
+    assert result['results']['s']['value'] == 24.0
+    
+    index = kparse.buildDependencyIndex(copy.deepcopy(columnar))
+    index['system'] = kparse.setValue(index['system'], 'items.item2.price', 20.0)
+    assert kparse.recompute(index, ['items.item2.price'])['values']['s'] == fresh(index['system'], 's')[0]
+    
+    observable = kparse.ObservableSystem(columnar)
+    heard = []
+    observable.subscribe('s', heard.append)
+    observable.setValue('items.item1.price', 1000.0)
+    observable.setValue('p', 20.0)
+    assert heard == [{'s' : 1022.0}, {'s' : 1032.0}]
+
+
+########################## Parallel evaluation ##########################
+
+# Threads can compile at the same time while the compile cache is full and evicting
+def testCompileCacheThreads(monkeypatch):
+    monkeypatch.setattr(kparse, 'compileCacheSize', 4)
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(0.0000001)
+    errors = []
+    def compileMany(seed):
+        choose = random.Random(seed)
+        try:
+            for i in range(50000): kparse.compileExpression('x' + str(choose.randrange(6)))
+        except Exception as error: errors.append(error)
+    threads = [threading.Thread(target=compileMany, args=(i,)) for i in range(8)]
+    try:
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+        kparse.compileCache.clear()
+    assert errors == []
+
+def parallelSystem():
+    return {'in' : 2, 't' : 0, 'set' : '(= parent.t (* parent.in 10))', 'useT' : '(+ parent.t 1)', 'useT2' : '(* parent.t parent.in)',
+            'free1' : '(+ parent.in 1)', 'free2' : '(sum [1,2,3])', 'g' : {'x' : 5, 'y' : '(* parent.x 2)'},
+            'setX' : '(= parent.g.x parent.in)', 'loop' : 'parent.loop'}
+
+# Evaluating in parallel gives the results and system evaluating the nodes one after another does, with threads or processes
+def testParallelMatchesSequential():
+    nodes = ['set', 'useT', 'useT2', 'free1', 'free2', 'g.y', 'setX', 'loop']
+    system = parallelSystem()
+    context = kparse.EvalContext(diagnostics='drop')
+    expected = {}
+    for node in nodes:
+        result = kparse.parse(system, node, context=context)
+        system = result['system']
+        expected[node] = (result['value'], result['wellDefined'])
+    assert system['t'] == 20.0 and system['g']['x'] == 2.0
+    
+    with ThreadPoolExecutor(3) as executor:
+        threaded = kparse.evaluateParallel(parallelSystem(), nodes, executor=executor, maxWorkers=3, diagnostics='drop')
+    processes = kparse.evaluateParallel(parallelSystem(), nodes, maxWorkers=3, diagnostics='drop')
+    for result in [threaded, processes]:
+        assert {node : (result['results'][node]['value'], result['results'][node]['wellDefined']) for node in nodes} == expected
+        assert result['system'] == system
+        
+        # Nodes reading what an '=' sets are in its group; the rest are on their own
+        assert result['groups'] == [['set', 'useT', 'useT2'], ['free1'], ['free2'], ['g.y', 'setX'], ['loop']]
+    assert kparse.independentGroups(parallelSystem(), nodes) == threaded['groups']
+
+
+########################## Diagnostics ##########################
+
+def problemSystem():
+    return {'a' : 'parent.b', 'b' : 'parent.a', 'c' : '(+ parent.nope.x 1)', 'd' : 2}
+
+# Entry points that evaluate many nodes report problems the way they're asked to, and give back what they collect
+def testDiagnosticsCollected():
+    found = [('loop', 'b'), ('loop', 'a'), ('not-evaluable', 'c')]
+    context = kparse.EvalContext(diagnostics='collect')
+    kparse.buildDependencyIndex(problemSystem(), None, context)
+    assert [(record['code'], record['path']) for record in context.records] == found
+    
+    with ThreadPoolExecutor(2) as executor:
+        result = kparse.evaluateParallel(problemSystem(), executor=executor, diagnostics='collect')
+    assert [(record['code'], record['path']) for record in result['diagnostics']] == found
+    assert [record['code'] for record in result['results']['c']['diagnostics']] == ['not-evaluable']
+    
+    observable = kparse.ObservableSystem(problemSystem(), diagnostics='collect')
+    observable.subscribe(['a', 'missing', 'c'], lambda changes: None)
+    assert sorted((record['code'], record['path']) for record in observable.records) == sorted(found + [('invalid-path', 'missing')])
+
+def testDiagnosticsDropped(caplog):
+    kparse.buildDependencyIndex(problemSystem(), None, kparse.EvalContext(diagnostics='drop'))
+    with ThreadPoolExecutor(2) as executor:
+        assert kparse.evaluateParallel(problemSystem(), executor=executor, diagnostics='drop')['diagnostics'] == []
+    observable = kparse.ObservableSystem(problemSystem(), diagnostics='drop')
+    observable.subscribe(['a', 'missing', 'c'], lambda changes: None)
+    assert observable.records == [] and caplog.records == []
+
+
+########################## Async inputs ##########################
+
+# Inputs the formula reads are fetched at the same time, and only once however many times they're read
+def testInputsFetchedConcurrently():
+    fetching = []
+    most = []
+    async def fetch(path):
+        fetching.append(path)
+        most.append(len(fetching))
+        await asyncio.sleep(0.01)
+        fetching.remove(path)
+        return {'p' : 10, 'q' : 20}[path]
+    system = {'p' : 1, 'q' : 2, 'r' : 3, 'f' : '(+ parent.p parent.q parent.p)', 'g' : '[parent.f,parent.q,parent.r]'}
+    result = asyncio.run(kparse.parseAsync(copy.deepcopy(system), 'g', {'p' : fetch, 'q' : fetch}))
+    assert result['value'] == [40.0, 20, 3]
+    assert sorted(most) == [1, 2]
+
+# A fetch that takes too long fails, is reported, and the system's value is used instead
+def testInputTimeout():
+    async def slow(path):
+        await asyncio.sleep(1)
+        return 100
+    async def fast(path):
+        return 10
+    system = {'p' : 1, 'q' : 2, 'f' : '(+ parent.p parent.q)'}
+    providers = {'p' : kparse.InputProvider(slow, timeout=0.01), 'q' : fast}
+    result = asyncio.run(kparse.parseAsync(copy.deepcopy(system), 'f', providers, diagnostics='collect'))
+    assert result['value'] == 11.0
+    assert [(record['code'], record['path']) for record in result['diagnostics']] == [('input-failed', 'p')]
+
+# Fetched values are kept for cacheFor seconds, and a path being fetched isn't fetched again at the same time
+def testInputCacheExpiry():
+    fetched = []
+    async def fetch(path):
+        fetched.append(path)
+        await asyncio.sleep(0.01)
+        return len(fetched)
+    provider = kparse.InputProvider(fetch, cacheFor=0.05)
+    async def run():
+        values = await asyncio.gather(provider.get('p'), provider.get('p'))
+        values.append(await provider.get('p'))
+        await asyncio.sleep(0.06)
+        values.append(await provider.get('p'))
+        return values
+    assert asyncio.run(run()) == [1, 1, 1, 2]
+    assert fetched == ['p', 'p']
+    
+    # With cacheFor=0 every read fetches again
+    provider = kparse.InputProvider(fetch, cacheFor=0)
+    async def again():
+        return [await provider.get('p'), await provider.get('p')]
+    assert asyncio.run(again()) == [3, 4]
+
+# An '=' that makes the formula read an input it wasn't known to read means fetching it and evaluating again
+def testInputFetchedAfterWrite():
+    fetched = []
+    async def fetch(path):
+        fetched.append(path)
+        return 42
+    system = {'x' : 0, 'd' : {'v' : '(+ parent.parent.remote 1)'}, 'remote' : 1, 'top' : '[(= parent.x parent.d),parent.x.v]'}
+    paths = kparse.PathIndex(system)
+    assert kparse.inputsNeeded(system, 'top', None, {'remote' : None}, paths) == []
+    result = asyncio.run(kparse.parseAsync(copy.deepcopy(system), 'top', {'remote' : fetch}))
+    assert result['value'] == [None, 43.0]
+    assert fetched == ['remote']
+    assert result['system']['x'] == system['d']
+
+
+########################## Static analysis ##########################
+
+def analyzedSystem():
+    return {'a' : '(+ parent.b 1)', 'b' : '(* parent.a 2)', 'self' : '(+ parent.self 1)', 'chain' : 'parent.a',
+            'u' : '(+ parent.nope.x parent.inner.y nothing)', 'inner' : {'y' : 2}, 'in' : 1, 't' : 0,
+            'w' : '(= parent.t parent.in)', 'out' : '(* parent.t 2)', 'unused' : '(+ parent.in 5)'}
+
+# Nodes that reference each other, or themselves, are cycles; a node that only leads into one isn't
+def testCycles():
+    analysis = kparse.analyzeSystem(analyzedSystem())
+    assert analysis['cycles'] == [['a', 'b'], ['self']]
+    assert analysis['references']['chain'] == ['a']
+    assert kparse.stronglyConnected({'x' : ['y'], 'y' : ['x', 'z'], 'z' : []}) == [['z'], ['x', 'y']]
+
+# Only variables with a dot that don't lead anywhere are unresolved
+def testUnresolved():
+    analysis = kparse.analyzeSystem(analyzedSystem())
+    assert analysis['unresolved'] == [{'node' : 'u', 'reference' : 'parent.nope.x'}]
+    assert analysis['references']['u'] == ['inner.y']
+
+# A node that sets something an output reads is live, and so is what it reads
+def testDeadNodes():
+    system = analyzedSystem()
+    assert kparse.analyzeSystem(system)['dead'] == []
+    assert kparse.analyzeSystem(system, ['out'])['dead'] == ['a', 'b', 'self', 'chain', 'u', 'inner.y', 'unused']
+    
+    # Without the '=', nothing sets t, so w and what it reads are dead too
+    system['w'] = '(+ parent.in 1)'
+    assert kparse.analyzeSystem(system, ['out'])['dead'] == ['a', 'b', 'self', 'chain', 'u', 'inner.y', 'in', 'w', 'unused']
+
+
+########################## Vectorized evaluation ##########################
+
+def numbersSystem():
+    return {'a' : [1.0, 2.0, 3.0], 'b' : [4, 5, 6], 'short' : [1, 2], 'n' : 2, 'zero' : [1, 0, 2],
+            'add' : '(+ parent.a parent.b)', 'times' : '(* parent.a parent.n)', 'fromNumber' : '(- parent.n parent.a)',
+            'divideNumber' : '(/ 12 parent.a)', 'pairs' : '(* parent.a parent.b 2)', 'longer' : '(+ parent.short parent.a)',
+            'compare' : '(< parent.a parent.b)', 'remainder' : '(% parent.b 4)', 'total' : '(sum parent.a)',
+            'product' : '(pi parent.b)', 'dotted' : '(dot parent.a parent.b)', 'joined' : '(union parent.a [1,9])',
+            'size' : '(cardinality parent.a)', 'nested' : '(sum (* parent.a (+ parent.b 1)))'}
+
+# Every formula gives the same value (as a list, for arrays) and wellDefined vectorized as it does without NumPy
+def testVectorizedMatchesScalar():
+    numpy = pytest.importorskip('numpy')
+    system = numbersSystem()
+    for node in system:
+        if not type(system[node]) == str: continue
+        scalar = kparse.parse(copy.deepcopy(system), node, context=kparse.EvalContext(diagnostics='drop'))
+        vectorized = kparse.parse(copy.deepcopy(system), node, context=kparse.EvalContext(vectorize=True, diagnostics='drop'))
+        value = vectorized['value'].tolist() if type(vectorized['value']) is numpy.ndarray else vectorized['value']
+        assert (value, vectorized['wellDefined']) == (scalar['value'], scalar['wellDefined']), node
+    
+    # Numbers distributed over arrays are applied to each element in turn, using the folded kernels
+    context = kparse.EvalContext(vectorize=True)
+    assert kparse.parse(system, 'fromNumber', context=context)['value'] == 2.0 - 1.0 - 2.0 - 3.0
+    assert kparse.parse(system, 'divideNumber', context=context)['value'] == 12.0 / 6.0
+
+# Lists matched pairwise need the second to be at least as long as the first, as they do without NumPy
+def testVectorizedLengthMismatch():
+    pytest.importorskip('numpy')
+    system = numbersSystem()
+    system['shorter'] = '(+ parent.a parent.short)'
+    for vectorize in [False, True]:
+        with pytest.raises(IndexError): kparse.parse(copy.deepcopy(system), 'shorter', context=kparse.EvalContext(vectorize=vectorize))
+    with pytest.raises(IndexError): kparse.parse(copy.deepcopy(system), 'shorter', context=kparse.EvalContext(vectorize=True), toEval='(dot parent.a parent.short)')
+
+# Dividing by zero raises (rather than giving inf or nan), as it does without NumPy
+def testVectorizedDivideByZero():
+    pytest.importorskip('numpy')
+    system = numbersSystem()
+    for formula in ['(/ parent.a parent.zero)', '(/ parent.a 0)', '(/ 1 parent.zero)', '(% parent.a parent.zero)']:
+        for vectorize in [False, True]:
+            with pytest.raises(ArithmeticError):
+                kparse.parse(copy.deepcopy(system), 'a', formula, context=kparse.EvalContext(vectorize=vectorize))
+
+# Lists of numbers (and typed arrays, and LazyLists over memory) are held as arrays; other values as they are
+def testAsArray():
+    numpy = pytest.importorskip('numpy')
+    context = kparse.EvalContext(vectorize=True)
+    assert type(context.asArray([1, 2.5])) is numpy.ndarray
+    assert type(context.asArray(array.array('q', [1, 2]))) is numpy.ndarray
+    lazy = context.asArray(kparse.LazyList(memoryview(array.array('d', [1.0, 2.0]))))
+    assert type(lazy) is numpy.ndarray and lazy.tolist() == [1.0, 2.0]
+    for value in [[], [1, 'x'], [1, [2]], [True, 1], 'text', 3]: assert context.asArray(value) is value
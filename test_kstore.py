@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Behavior tests for kstore (run with pytest)
+"""
+
+import copy
+import array
+
+import pytest
+
+import kparse
+import kstore
+
+
+def numbersSystem():
+    return {'f' : list(range(100)), 'g' : [i / 3.0 for i in range(100)], 'small' : [1, 2], 'name' : 'hello',
+            'inner' : {'x' : 4, 'y' : '(* parent.x 2)'},
+            'plus' : '(+ parent.f 1)', 'total' : '(sum parent.g)', 'both' : '(union parent.f [1,2])',
+            'product' : '(dot parent.f parent.g)', 'size' : '(cardinality parent.f)', 'same' : '(intersection parent.f parent.small)'}
+
+# Every node of a loaded system evaluates to what it does in memory
+def testRoundTrip(tmp_path):
+    system = numbersSystem()
+    fileName = str(tmp_path / 'system.ks')
+    kstore.saveSystem(system, fileName)
+    loaded = kstore.loadSystem(fileName)
+    
+    assert loaded['nodes'] == kparse.listNodes(system)
+    assert type(loaded['system']['f']) is array.array
+    for node in ['plus', 'total', 'both', 'product', 'size', 'same', 'inner.y', 'name', 'small']:
+        expected = kparse.parse(copy.deepcopy(system), node)['value']
+        value = kparse.parse(loaded['system'], node)['value']
+        assert type(value) == type(expected) and value == expected, node
+
+# Loading lazily leaves arrays in the file, as LazyLists
+def testLazyLoad(tmp_path):
+    system = numbersSystem()
+    fileName = str(tmp_path / 'system.ks')
+    kstore.saveSystem(system, fileName)
+    loaded = kstore.loadSystem(fileName, lazy=True)
+    
+    assert type(loaded['system']['f']) is kparse.LazyList
+    assert list(loaded['system']['f']) == system['f']
+    assert kparse.parse(loaded['system'], 'total', context=kparse.EvalContext(lazy=True))['value'] == sum(system['g'])
+    
+    # And a lazily loaded system can be saved again
+    again = str(tmp_path / 'again.ks')
+    kstore.saveSystem(loaded['system'], again)
+    assert list(kstore.loadSystem(again)['system']['g']) == system['g']
+
+# Files from an older format this version can read are loaded; files from a format it doesn't know are refused
+def testFormatVersions(tmp_path):
+    fileName = str(tmp_path / 'system.ks')
+    kstore.saveSystem(numbersSystem(), fileName)
+    with open(fileName, 'rb') as f: data = f.read()
+    
+    with open(fileName, 'wb') as f: f.write(b'KSYS' + (1).to_bytes(4, 'big') + data[8:])
+    assert kparse.parse(kstore.loadSystem(fileName)['system'], 'total')['value'] == sum(numbersSystem()['g'])
+    
+    with open(fileName, 'wb') as f: f.write(b'KSYS' + (kstore.formatVersion + 1).to_bytes(4, 'big') + data[8:])
+    with pytest.raises(ValueError): kstore.loadSystem(fileName)
+
+# Collections are stored as their columns, and load (lazily or not) as collections that read the same
+def testColumnsRoundTrip(tmp_path):
+    rows = {'item' + str(i) : {'price' : float(i), 'qty' : i % 3, 'name' : 'n' + str(i), 'total' : '(* parent.price parent.qty)'}
+            for i in range(10)}
+    system = {'items' : kparse.columnsFromRows(rows), 'sum' : '(sum parent.items.price)', 'value' : '(dot parent.items.price parent.items.qty)'}
+    fileName = str(tmp_path / 'system.ks')
+    kstore.saveSystem(system, fileName)
+    
+    for lazy in [False, True]:
+        loaded = kstore.loadSystem(fileName, lazy=lazy)['system']
+        assert type(loaded['items']) is kparse.ColumnarCollection
+        assert {key : dict(row) for key, row in loaded['items'].items()} == rows
+        for node in ['sum', 'value', 'items.item4.total']:
+            assert kparse.parse(loaded, node)['value'] == kparse.parse(system, node)['value'], node
+    
+    loaded = kstore.loadSystem(fileName)['system']
+    assert type(loaded['items'].columns['price']) is array.array
+    kparse.setValue(loaded, 'items.item1.price', 100.0)
+    assert kparse.parse(loaded, 'value')['value'] == kparse.parse(system, 'value')['value'] + 99.0
+
+# Stored compiled formulas aren't used once the operators they were compiled with have changed
+def testCompiledWithOtherOperators(tmp_path):
+    fileName = str(tmp_path / 'system.ks')
+    kstore.saveSystem({'a' : [5, 2], 'm' : '(maxof parent.a)', 'c' : '(maxof [1,3])'}, fileName)
+    kparse.registerOperator('maxof', lambda A: max(A), 1, 'sets')
+    try:
+        loaded = kstore.loadSystem(fileName)['system']
+        assert kparse.parse(loaded, 'm')['value'] == 5
+        assert kparse.parse(loaded, 'c')['value'] == 3
+    finally:
+        del kparse.operatorRegistry['maxof']
+        kparse.operators.remove('maxof')
+        kparse.compileCache.clear()
+    
+    # With the same operators they're used as they are
+    kparse.compileCache.clear()
+    kstore.loadSystem(fileName)
+    assert kparse.compileCache['(maxof parent.a)'] == {'kind' : 'text', 'value' : '(maxof parent.a)'}